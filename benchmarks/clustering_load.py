@@ -0,0 +1,99 @@
+"""
+Measure load time and peak RSS of Clustering.load_images against the previous list-then-convert loader on
+synthetic greyscale screenshots. Every loader runs in its own process so that peak RSS is reported per loader.
+Everything, including the fingerprint cache database, is created in a temporary directory.
+
+Run from the repository root:
+    python -m benchmarks.clustering_load --count 10000
+
+Results for 10,000 synthetic 2560x1440 screenshots on a machine with 1 CPU and 6GB of RAM:
+    after, cold cache, memory-mapped: 185.4s, peak RSS 1627MB
+    after, warm cache, memory-mapped: 14.0s, peak RSS 4081MB, mostly pages of the mapped file that the kernel can
+                                      write back and evict
+    after, warm cache, uint8: 7.1s, peak RSS 1608MB
+    after, warm cache: killed for running out of memory, the float32 matrix alone takes 6GB
+    before: killed for running out of memory
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+
+
+def legacy_load(folder, paths):
+    images = []
+    for image in paths:
+        images.append(cv2.cvtColor(cv2.resize(cv2.imread(f"{folder}/{image}"), (224, 224)), cv2.COLOR_BGR2RGB))
+    images = np.float32(images).reshape(len(images), -1)
+    images /= 255
+    return images
+
+
+def run(label, folder, mmap_path, dtype, results):
+    from clustering import Clustering
+
+    start = time.perf_counter()
+    if label == 'before':
+        legacy_load(folder, [path for path in os.listdir(folder) if path.endswith('.png')])
+    else:
+        # Clustering recreates CLUSTER_OUTPUT_PATH, which is relative to the temporary working directory
+        clustering = Clustering(folder, n_clusters=1)
+        clustering.load_images(dtype=dtype, mmap_path=mmap_path)
+    elapsed = time.perf_counter() - start
+
+    results.put((label, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def generate(folder, count, width, height):
+    os.makedirs(folder)
+    base = np.random.RandomState(728).randint(0, 255, (height, width), dtype=np.uint8)
+    for i in range(count):
+        image = base.copy()
+        image[(i * 37) % height:(i * 37) % height + 40] = i % 255
+        cv2.imwrite(f"{folder}/site_{i}.png", image)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--width', type=int, default=2560)
+    parser.add_argument('--height', type=int, default=1440)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.makedirs('storage/logs')
+        os.makedirs('storage/cluster_output')
+
+        from main import migrate_fresh
+        from models.Base import engine
+
+        migrate_fresh()
+        engine.dispose()
+
+        generate('data', args.count, args.width, args.height)
+
+        results = multiprocessing.Queue()
+        # The in-memory float32 matrices need 602KB per image, so they run last in case they do not fit in RAM
+        runs = [('after, cold cache, memory-mapped', 'images.npy', np.float32),
+                ('after, warm cache, memory-mapped', 'images.npy', np.float32),
+                ('after, warm cache, uint8', None, np.uint8), ('after, warm cache', None, np.float32),
+                ('before', None, np.float32)]
+        for label, mmap_path, dtype in runs:
+            process = multiprocessing.Process(target=run, args=(label, 'data', mmap_path, dtype, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"{label}: failed")
+                continue
+            label, elapsed, peak_rss = results.get()
+            print(f"{label}: {args.count} images in {elapsed:.2f}s, peak RSS {peak_rss:.0f}MB")
@@ -0,0 +1,83 @@
+"""
+Compare the row by row parse_collected_data + convert_parsed_to_site path with the bulk ingest_collected_data path
+on a synthetic Alexa dump. Each path runs against its own temporary SQLite database.
+
+Run from the repository root:
+    python -m benchmarks.ingestion --sites 100000
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+import main
+from migrations.Response import Response
+from models.Base import Base, Session
+import services.Log as Log
+
+
+def synthetic_response(start, count):
+    sites = []
+    for rank in range(start, start + count):
+        sites.append({
+            'DataUrl': f"site{rank}.example.com",
+            'Global': {'Rank': str(rank)},
+            'Country': {
+                'Reach': {'PerMillion': str(1000000 // rank)},
+                'PageViews': {'PerMillion': str(500000 // rank), 'PerUser': '2.5'}
+            }
+        })
+    return {'Ats': {'Results': {'Result': {'Alexa': {'TopSites': {'Country': {'Sites': {'Site': sites}}}}}}}}
+
+
+def prepare(directory, label, sites, per_response):
+    engine = create_engine(f"sqlite:///{directory}/{label}.sqlite3")
+    Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+
+    session = Session()
+    session.bulk_insert_mappings(Response, [
+        {'query': f"synthetic?Start={start}", 'start': start, 'response': synthetic_response(start, per_response)}
+        for start in range(1, sites + 1, per_response)
+    ])
+    session.commit()
+    session.close()
+
+
+def measure(label, fn, sites):
+    # Progress is logged at INFO, and the log's console handler writes to the real stdout whatever it is redirected
+    # to, so the pipeline's logging is turned down instead of redirecting stdout
+    logger = logging.getLogger(Log.ROOT)
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+    finally:
+        logger.setLevel(level)
+
+    # Both paths write one ParsedResponse and one Site row per synthetic site
+    rows = sites * 2
+    print(f"{label}: {rows} rows in {elapsed:.2f}s, {rows / elapsed:.0f} rows/sec")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sites', type=int, default=100000)
+    parser.add_argument('--per-response', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        prepare(directory, 'before', args.sites, args.per_response)
+        before = measure('before (row by row)',
+                         lambda: (main.parse_collected_data(), main.convert_parsed_to_site()), args.sites)
+
+        prepare(directory, 'after', args.sites, args.per_response)
+        after = measure('after (bulk)', main.ingest_collected_data, args.sites)
+
+    print(f"Speedup: {before / after:.1f}x")
@@ -0,0 +1,108 @@
+"""
+Compare concurrent writers on a bare SQLite engine (rollback journal, full sync, 5s lock timeout) with the engine
+profile from models.Base.create_database_engine. Every writer process commits one Screenshot row at a time, as the
+capture workers do, while a reader process keeps polling for unprocessed sites. Each profile runs against its own
+temporary database.
+
+Run from the repository root:
+    python -m benchmarks.sqlite_writers --writers 4 --rows 200
+"""
+
+import argparse
+import multiprocessing
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.session import sessionmaker
+
+from migrations.Screenshot import Screenshot
+from migrations.Site import Site
+from models.Base import Base, create_database_engine
+from models.Screenshot import ScreenshotEnum
+
+
+def engine_for(profile, url):
+    if profile == 'bare':
+        return create_engine(url)
+    return create_database_engine(url)
+
+
+def write(profile, url, writer, rows, results):
+    Session = sessionmaker(bind=engine_for(profile, url))
+    session = Session()
+    failures = 0
+    start = time.perf_counter()
+    for i in range(rows):
+        session.add(Screenshot(site_id=writer + 1, path=f"writer{writer}/{i}.png", type=ScreenshotEnum.RGB))
+        try:
+            session.commit()
+        except OperationalError:
+            session.rollback()
+            failures += 1
+    results.put((time.perf_counter() - start, failures))
+    session.close()
+
+
+def read(profile, url, stop, results):
+    Session = sessionmaker(bind=engine_for(profile, url))
+    queries = 0
+    failures = 0
+    while not stop.is_set():
+        session = Session()
+        try:
+            session.query(Site.id).filter_by(processed=False).count()
+            queries += 1
+        except OperationalError:
+            failures += 1
+        finally:
+            session.close()
+    results.put((queries, failures))
+
+
+def run(profile, directory, writers, rows):
+    url = f"sqlite:///{directory}/{profile}.sqlite3"
+    engine = engine_for(profile, url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Site.__table__.insert(),
+                           [{'name': f"site{i}", 'host': f"site{i}.com"} for i in range(writers)])
+    engine.dispose()
+
+    write_results = multiprocessing.Queue()
+    read_results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    reader = multiprocessing.Process(target=read, args=(profile, url, stop, read_results))
+    processes = [multiprocessing.Process(target=write, args=(profile, url, i, rows, write_results))
+                 for i in range(writers)]
+
+    start = time.perf_counter()
+    reader.start()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    reader.join()
+
+    failures = sum(write_results.get()[1] for _ in processes)
+    queries, read_failures = read_results.get()
+    written = writers * rows - failures
+    print(f"{profile}: {written} commits in {elapsed:.2f}s, {written / elapsed:.0f} commits/sec, "
+          f"{failures} failed writes, {queries} reads with {read_failures} failed")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        before = run('bare', directory, args.writers, args.rows)
+        after = run('tuned', directory, args.writers, args.rows)
+
+    print(f"Speedup: {before / after:.1f}x")
@@ -8,129 +8,325 @@ import os
 import random
 import shutil
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import joblib
 import keras
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
-from main import file_safe_timestamp
-import datetime
-from config.app import CLUSTER_DATA_PATH, CLUSTER_OUTPUT_PATH, STORAGE_LOGS_PATH
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA, PCA
+import services.FingerprintCache as FingerprintCache
+import services.Log as Log
+from config.app import CLUSTER_DATA_PATH, CLUSTER_OUTPUT_PATH, CLUSTER_LOAD_WORKERS, CLUSTER_BATCH_SIZE, \
+    CLUSTER_MODEL_PATH, EMBEDDING_BATCH_SIZE
+from migrations.Site import Site
+from models.Base import Session
+from services.EmbeddingStore import backbone_store
+
+log = Log.get(__name__)
 
 
 class Clustering:
-    def __init__(self, folder_path="data", n_clusters=10, max_examples=None, use_imagenets=False, use_pca=False):
-        filename = f"clustering_{file_safe_timestamp()}.log"
-        self.file = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-        self.file.write(str(datetime.datetime.now()) + "\n\n")
-        self.file.write("\n\n \t\t START\n\n")
-        paths = os.listdir(folder_path)
+    def __init__(self, folder_path="data", n_clusters=10, max_examples=None, use_imagenets=False, use_pca=False,
+                 image_paths=None, reset_output=True):
+        """
+        :param image_paths: File names to load from folder_path, in this order, instead of every .png in a random
+                            order
+        :param reset_output: Recreate the cluster folders in CLUSTER_OUTPUT_PATH, pass False to only vectorise images
+        """
+        if image_paths is None:
+            paths = [path for path in os.listdir(folder_path) if path.endswith('.png')]
+            random.shuffle(paths)
+        else:
+            paths = list(image_paths)
 
         self.max_examples = len(paths) if max_examples is None else len(paths) if max_examples > len(
             paths) else max_examples
 
         self.n_clusters = n_clusters
         self.folder_path = folder_path
-        random.shuffle(paths)
         self.image_paths = paths[:self.max_examples]
         self.use_imagenets = use_imagenets
         self.use_pca = use_pca
+        # PCA fitted on the embeddings when use_pca is set, reused as is when already set
+        self.vector_pca = None
         del paths
 
+        if not reset_output:
+            return
+
         try:
             shutil.rmtree(CLUSTER_OUTPUT_PATH)
         except FileExistsError:
             pass
 
-        print("\n output folders created.")
-        self.file.write("\n output folders created.")
         os.makedirs(CLUSTER_OUTPUT_PATH)
 
         for i in range(self.n_clusters):
             os.makedirs(f"{CLUSTER_OUTPUT_PATH}/cluster{str(i)}")
+        log.info("Output folders created")
+        log.info("Clustering %s images from %s into %s clusters", self.max_examples, folder_path, n_clusters)
+
+    def load_images(self, dtype=np.float32, mmap_path=None, workers=CLUSTER_LOAD_WORKERS):
+        """
+        Load every image into one preallocated (n, 224 * 224 * 3) matrix, filled in parallel by a thread pool.
+        Float matrices are scaled to [0, 1] row by row as they are filled.
+
+        :param dtype: np.float32, or np.uint8 to keep raw pixel values at a quarter of the memory
+        :param mmap_path: Optional .npy path to back the matrix with a memory-mapped file, for datasets larger
+                          than RAM
+        :param workers: Number of loader threads
+        :return: None
+        """
+        start = time.perf_counter()
+        shape = (len(self.image_paths), 224 * 224 * 3)
+        if mmap_path is None:
+            self.images = np.empty(shape, dtype=dtype)
+        else:
+            self.images = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=dtype, shape=shape)
 
-        print("\n Object of class \"Clustering\" has been initialized.")
-        self.file.write("\n Object of class \"Clustering\" has been initialized.")
+        # Rows hold pixel values divided by scale
+        scale = self.scale = 1 if np.issubdtype(self.images.dtype, np.integer) else 255
 
-    def load_images(self):
-        self.images = []
+        # Cluster data holds greyscale screenshots, so the cached greyscale thumbnail is expanded back to three
+        # channels instead of decoding the full image again
+        def load(i):
+            thumbnail = FingerprintCache.thumbnail(f"{self.folder_path}/{self.image_paths[i]}", remember=False)
+            np.divide(cv2.cvtColor(thumbnail, cv2.COLOR_GRAY2RGB).reshape(-1), scale, out=self.images[i],
+                      casting='unsafe')
 
-        for image in self.image_paths:
-            if image.endswith('.png'):
-                self.images.append(cv2.cvtColor(cv2.resize(cv2.imread(
-                    f"{self.folder_path}/{image}"), (224, 224)), cv2.COLOR_BGR2RGB))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(load, range(len(self.image_paths))))
 
-        self.images = np.float32(self.images).reshape(len(self.images), -1)
-        self.images /= 255
+        if mmap_path is not None:
+            self.images.flush()
 
-        print(
-            f"\n {str(self.max_examples)} images from the {self.folder_path} folder have been loaded in a random order.")
-        self.file.write(
-            f"\n {str(self.max_examples)} images from the {self.folder_path} folder have been loaded in a random order.")
+        elapsed = time.perf_counter() - start
 
-    def get_new_imagevectors(self):
+        log.info("%s images from the %s folder have been loaded", self.max_examples, self.folder_path)
+        log.info("Loaded in %.2fs, peak RSS %s", elapsed, peak_rss())
+
+    def get_new_imagevectors(self, batch_size=EMBEDDING_BATCH_SIZE):
+        """
+        Turn the loaded images into the vectors to cluster. With use_imagenets, images are passed through the
+        chosen keras backbone batch_size at a time, and the embeddings are kept in an EmbeddingStore keyed by image
+        content. Each batch is brought back to 0-255 pixel values and passed through the backbone's preprocess_input,
+        so embeddings do not depend on the dtype the images were loaded with. Only images without a stored embedding
+        go through the network, and the backbone is not loaded at all when every embedding is already stored, so
+        re-clustering costs only the clustering step.
+
+        :param batch_size: Number of images per forward pass
+        :return: None
+        """
         if not self.use_imagenets:
             self.images_new = self.images
         else:
-            if use_imagenets.lower() == "vgg16":
-                model = keras.applications.vgg16.VGG16(
-                    include_top=False, weights="imagenet", input_shape=(224, 224, 3))
-            elif use_imagenets.lower() == "vgg19":
-                model = keras.applications.vgg19.VGG19(
-                    include_top=False, weights="imagenet", input_shape=(224, 224, 3))
-            elif use_imagenets.lower() == "resnet50":
-                model = keras.applications.resnet50.ResNet50(
-                    include_top=False, weights="imagenet", input_shape=(224, 224, 3))
-            elif use_imagenets.lower() == "xception":
-                model = keras.applications.xception.Xception(
-                    include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-            elif use_imagenets.lower() == "inceptionv3":
-                keras.applications.inception_v3.InceptionV3(
-                    include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-            elif use_imagenets.lower() == "inceptionresnetv2":
-                model = keras.applications.inception_resnet_v2.InceptionResNetV2(
-                    include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-            elif use_imagenets.lower() == "densenet":
-                model = keras.applications.densenet.DenseNet201(
-                    include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-            elif use_imagenets.lower() == "mobilenetv2":
-                model = keras.applications.mobilenetv2.MobileNetV2(input_shape=(
-                    224, 224, 3), alpha=1.0, depth_multiplier=1, include_top=False, weights='imagenet', pooling=None)
-            else:
-                print(
-                    "\n\n Please use one of the following keras applications only [ \"vgg16\", \"vgg19\", "
-                    "\"resnet50\", \"xception\", \"inceptionv3\", \"inceptionresnetv2\", \"densenet\", "
-                    "\"mobilenetv2\" ] or False")
-                self.file.write(
-                    "\n\n Please use one of the following keras applications only [ \"vgg16\", \"vgg19\", "
-                    "\"resnet50\", \"xception\", \"inceptionv3\", \"inceptionresnetv2\", \"densenet\", "
-                    "\"mobilenetv2\" ] or False")
-                self.file.close()
-                sys.exit()
-
-            pred = model.predict(self.images)
-            images_temp = pred.reshape(self.images.shape[0], -1)
+            store = backbone_store(self.use_imagenets)
+            keys = [FingerprintCache.get(f"{self.folder_path}/{image}", remember=False).content_hash
+                    for image in self.image_paths]
+            # Row of the first image for every key without a stored embedding, duplicates share one embedding
+            missing = {}
+            for i, key in enumerate(keys):
+                if key not in store and key not in missing:
+                    missing[key] = i
+
+            if missing:
+                model, preprocess = self.__backbone()
+                log.info("Extracting %s embeddings in batches of %s", len(missing), batch_size)
+
+                rows = list(missing.values())
+
+                def batches():
+                    for start in range(0, len(rows), batch_size):
+                        batch = np.asarray(self.images[rows[start:start + batch_size]], dtype=np.float32) * self.scale
+                        pred = model.predict(preprocess(batch.reshape(-1, 224, 224, 3)), batch_size=batch_size)
+                        yield pred.reshape(len(batch), -1)
+
+                store.append(list(missing), batches())
+
+            images_temp = store.get(keys)
             if not self.use_pca:
                 self.images_new = images_temp
+            elif self.vector_pca is None:
+                self.vector_pca = PCA(n_components=None, random_state=728)
+                self.images_new = self.vector_pca.fit_transform(images_temp)
             else:
-                model2 = PCA(n_components=None, random_state=728)
-                model2.fit(images_temp)
-                self.images_new = model2
+                self.images_new = self.vector_pca.transform(images_temp)
+
+    def __backbone(self):
+        """
+        Keras backbone chosen by use_imagenets, with the preprocess_input function of its application module
+
+        :return: tuple of the model and the preprocessing function
+        """
+        if self.use_imagenets.lower() == "vgg16":
+            application = keras.applications.vgg16
+            model = application.VGG16(include_top=False, weights="imagenet", input_shape=(224, 224, 3))
+        elif self.use_imagenets.lower() == "vgg19":
+            application = keras.applications.vgg19
+            model = application.VGG19(include_top=False, weights="imagenet", input_shape=(224, 224, 3))
+        elif self.use_imagenets.lower() == "resnet50":
+            application = keras.applications.resnet50
+            model = application.ResNet50(include_top=False, weights="imagenet", input_shape=(224, 224, 3))
+        elif self.use_imagenets.lower() == "xception":
+            application = keras.applications.xception
+            model = application.Xception(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
+        elif self.use_imagenets.lower() == "inceptionv3":
+            application = keras.applications.inception_v3
+            model = application.InceptionV3(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
+        elif self.use_imagenets.lower() == "inceptionresnetv2":
+            application = keras.applications.inception_resnet_v2
+            model = application.InceptionResNetV2(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
+        elif self.use_imagenets.lower() == "densenet":
+            application = keras.applications.densenet
+            model = application.DenseNet201(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
+        elif self.use_imagenets.lower() == "mobilenetv2":
+            application = keras.applications.mobilenetv2
+            model = application.MobileNetV2(input_shape=(224, 224, 3), alpha=1.0, depth_multiplier=1,
+                                            include_top=False, weights='imagenet', pooling=None)
+        else:
+            log.error("Please use one of the following keras applications only [ \"vgg16\", \"vgg19\", "
+                      "\"resnet50\", \"xception\", \"inceptionv3\", \"inceptionresnetv2\", \"densenet\", "
+                      "\"mobilenetv2\" ] or False")
+            sys.exit()
+
+        return model, application.preprocess_input
 
     def clustering(self):
         model = KMeans(n_clusters=self.n_clusters, n_jobs=-1, random_state=728)
         model.fit(self.images_new)
         predictions = model.predict(self.images_new)
+        self.__finish(predictions)
+
+    def clustering_streaming(self, batch_size=CLUSTER_BATCH_SIZE, pca_components=None, epochs=1):
+        """
+        Cluster with MiniBatchKMeans fitted chunk by chunk, optionally after an IncrementalPCA fitted the same way.
+        Only batch_size rows are read at a time, so a memory-mapped matrix from load_images(mmap_path=...) is
+        never read into memory as a whole. The fitted models are saved to CLUSTER_MODEL_PATH, together with the
+        settings that turned images into vectors, so that new screenshots can later be placed with assign_images.
+
+        :param batch_size: Number of rows per chunk
+        :param pca_components: Number of IncrementalPCA components, or None to cluster the vectors directly
+        :param epochs: Number of passes over the data for the k-means fit
+        :return: None
+        """
+        pca = None
+        if pca_components:
+            pca = IncrementalPCA(n_components=pca_components, batch_size=batch_size)
+            for chunk in chunks(self.images_new, max(batch_size, pca_components)):
+                pca.partial_fit(chunk)
+
+        model = MiniBatchKMeans(n_clusters=self.n_clusters, batch_size=batch_size, random_state=728)
+        for _ in range(epochs):
+            for chunk in chunks(self.images_new, max(batch_size, self.n_clusters)):
+                model.partial_fit(pca.transform(chunk) if pca else chunk)
+
+        joblib.dump({'pca': pca, 'kmeans': model, 'vectors': self.vector_settings()}, CLUSTER_MODEL_PATH)
+
+        predictions = np.concatenate([model.predict(pca.transform(chunk) if pca else chunk)
+                                      for chunk in chunks(self.images_new, batch_size)])
+        self.__finish(predictions)
+
+    def vector_settings(self):
+        """
+        Everything assign_images needs to vectorise new images the way this instance did
+
+        :return: dict
+        """
+        return {'dtype': self.images.dtype, 'use_imagenets': self.use_imagenets, 'use_pca': self.use_pca,
+                'vector_pca': self.vector_pca}
+
+    def __finish(self, predictions):
         for i in range(self.max_examples):
             shutil.copy2(f"{self.folder_path}/{self.image_paths[i]}",
                          f"{CLUSTER_OUTPUT_PATH}/cluster{str(predictions[i])}")
-        print(
-            f"\n Clustering complete! \n\n Clusters and the respective images are stored in the \"{CLUSTER_OUTPUT_PATH}\" folder.")
-        self.file.write(
-            f"\n Clustering complete! \n\n Clusters and the respective images are stored in the \"{CLUSTER_OUTPUT_PATH}\" folder.")
-        self.file.write("\n\n\t\t END\n\n")
-        self.file.close()
+        save_assignments(self.image_paths, predictions)
+        log.info("Clustering complete, clusters and the respective images are stored in the \"%s\" folder",
+                 CLUSTER_OUTPUT_PATH)
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process, for logging
+
+    :return: str
+    """
+    try:
+        # Unix only
+        import resource
+    except ImportError:
+        return "unknown"
+    return f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB"
+
+
+def chunks(matrix, size):
+    """
+    Yield consecutive row slices of matrix, reading a memory-mapped matrix one slice at a time
+    """
+    for start in range(0, len(matrix), size):
+        yield np.asarray(matrix[start:start + size], dtype=np.float32)
+
+
+def save_assignments(image_names, predictions):
+    """
+    Write each image's cluster to Site.cluster. Cluster data files are named after the site, as written by
+    copy_unique_screenshots.
+
+    :param image_names: File names of the clustered images
+    :param predictions: Cluster of each image
+    :return: None
+    """
+    clusters = {os.path.splitext(name)[0]: int(cluster) for name, cluster in zip(image_names, predictions)}
+    names = list(clusters)
+
+    session = Session()
+    mappings = []
+    for start in range(0, len(names), 500):
+        for site_id, name in session.query(Site.id, Site.name).filter(Site.name.in_(names[start:start + 500])):
+            mappings.append({'id': site_id, 'cluster': clusters[name]})
+    session.bulk_update_mappings(Site, mappings)
+    session.commit()
+    session.close()
+
+
+def assign_images(folder_path, image_names, update=True, batch_size=CLUSTER_BATCH_SIZE):
+    """
+    Place new screenshots into the clusters fitted by Clustering.clustering_streaming without refitting, copying
+    them into their cluster folders and recording the assignment in the database. The new images are vectorised
+    through Clustering with the settings saved alongside the model: the same load dtype, backbone and fitted PCA.
+
+    :param folder_path: Folder holding the new images
+    :param image_names: File names of the new images
+    :param update: Also partial_fit the saved k-means model on the new images, moving the centres towards them
+    :param batch_size: Number of rows per chunk
+    :return: numpy.ndarray of cluster indices
+    """
+    models = joblib.load(CLUSTER_MODEL_PATH)
+    pca, model = models['pca'], models['kmeans']
+    # Models saved before the settings were recorded were always fitted on float pixel vectors
+    settings = models.get('vectors', {'dtype': np.float32, 'use_imagenets': False, 'use_pca': False,
+                                      'vector_pca': None})
+
+    clustering = Clustering(folder_path, use_imagenets=settings['use_imagenets'], use_pca=settings['use_pca'],
+                            image_paths=image_names, reset_output=False)
+    clustering.vector_pca = settings['vector_pca']
+    clustering.load_images(dtype=settings['dtype'])
+    clustering.get_new_imagevectors()
+
+    vectors = [pca.transform(chunk) if pca else chunk for chunk in chunks(clustering.images_new, batch_size)]
+    if update:
+        for chunk in vectors:
+            model.partial_fit(chunk)
+        joblib.dump(models, CLUSTER_MODEL_PATH)
+
+    predictions = np.concatenate([model.predict(chunk) for chunk in vectors])
+    for name, cluster in zip(clustering.image_paths, predictions):
+        shutil.copy2(f"{folder_path}/{name}", f"{CLUSTER_OUTPUT_PATH}/cluster{str(cluster)}")
+    save_assignments(clustering.image_paths, predictions)
+
+    return predictions
 
 
 if __name__ == "__main__":
@@ -6,14 +6,54 @@ LOGGING = True
 SCREENSHOT_ROOT_PATH = './storage/screenshots'
 SCREENSHOT_RGB_PATH = f'{SCREENSHOT_ROOT_PATH}/original'
 SCREENSHOT_GREY_PATH = f'{SCREENSHOT_ROOT_PATH}/greyscale'
+SCREENSHOT_CROP_PATH = f'{SCREENSHOT_ROOT_PATH}/cropped'
+CROP_WIDTH = 2560
+CROP_HEIGHT = 1440
+HEADER_SCAN_WORKERS = 16
+CROP_WORKERS = 4
+OVERLAY_WORKERS = 4
+# Images written per overlaid subcluster, any of 'mean', 'variance' and 'heatmap'
+OVERLAY_OUTPUTS = ('mean',)
+GREYSCALE_WORKERS = 4
+# PNG compression level (0-9) for greyscale copies, lower levels encode faster for larger files
+GREYSCALE_COMPRESSION = 3
 
 CLUSTER_DATA_PATH = './storage/cluster_data'
 CLUSTER_OUTPUT_PATH = './storage/cluster_output'
+CLUSTER_LOAD_WORKERS = 8
+CLUSTER_BATCH_SIZE = 1024
+CLUSTER_MODEL_PATH = './storage/cluster_model.joblib'
+
+EMBEDDING_STORE_PATH = './storage/embeddings'
+EMBEDDING_BATCH_SIZE = 32
+
+ANN_INDEX_PATH = './storage/ann_index.npz'
 
 ################################
 # Query tracking configuration #
 ################################
-QUERY_START_FILENAME = 'query_start.txt'
-QUERY_START_PATH = f'./storage/{QUERY_START_FILENAME}'
+ALEXA_API_URL = 'https://ats.api.alexa.com/api'
+QUERY_CONCURRENCY = 4
+QUERY_RETRIES = 5
+QUERY_BACKOFF = 1
+RANKINGS_PATH = './storage/rankings.npz'
+RESPONSE_ARCHIVE_PATH = './storage/responses.gz'
 
 STORAGE_LOGS_PATH = './storage/logs'
+
+############################
+# Similarity configuration #
+############################
+# One of 'phash', 'dhash', 'ssim' or 'deepai'. Local backends return distances between 0 and 64.
+SIMILARITY_BACKEND = 'phash'
+
+# Public suffix list used to group hosts, None for the copy bundled with the tld package
+PUBLIC_SUFFIX_LIST_PATH = None
+
+#########################
+# Logging configuration #
+#########################
+# LOGGING turns the JSON-lines run log in STORAGE_LOGS_PATH on or off; the console always gets INFO and above
+LOG_LEVEL = 'INFO'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
@@ -4,3 +4,9 @@ import os
 database_name = 'screenshots'
 database = os.path.join(os.path.dirname('storage/'), f"{database_name}.sqlite3")
 conn_string = f'sqlite:///{database}'
+
+# SQLite connection profile. WAL lets readers run alongside the single writer, synchronous NORMAL only syncs at
+# checkpoints in WAL mode, and busy_timeout (seconds) makes writers wait for the lock instead of failing at once.
+sqlite_journal_mode = 'WAL'
+sqlite_synchronous = 'NORMAL'
+sqlite_busy_timeout = 30
@@ -2,3 +2,30 @@ SCROLL_PAUSE_TIME = 5
 MAX_SCROLL_HEIGHT = 30000
 RESCROLL_PAUSE_TIME = 0.5
 RESCROLL_INCREMENTS = 200
+
+WORKER_COUNT = 4
+WORKER_MAX_PAGES = 50
+
+# Capture jobs are leased to a worker for JOB_LEASE_TIME seconds, after which another worker may reclaim them. The
+# lease must outlast the slowest capture, including CAPTURE_SCRIPT_TIMEOUT.
+JOB_LEASE_TIME = 900
+JOB_MAX_ATTEMPTS = 3
+
+# Wait for network idle, scrollHeight stability and visible images instead of sleeping for the full pause time.
+# The pause times above become the ceiling for each wait.
+ADAPTIVE_SETTLE = True
+SCROLL_QUIET_TIME = 0.5
+RESCROLL_QUIET_TIME = 0.1
+
+# Run scroll/rescroll as a single injected script instead of one WebDriver call per step
+SINGLE_ROUND_TRIP_CAPTURE = True
+CAPTURE_SCRIPT_TIMEOUT = 600
+
+# Capture pages at least this tall as viewport-sized tiles streamed into the PNG, bounding peak memory
+TILED_CAPTURE = True
+TILED_CAPTURE_MIN_HEIGHT = 10000
+TILED_CAPTURE_COMPRESSION = 6
+
+# Write the greyscale and cropped copies and their fingerprints from the captured bytes, instead of reading the RGB
+# file back in later stages. Tiled captures are streamed to disk and are left to the later stages.
+CAPTURE_POST_PROCESS = False
@@ -1,24 +1,48 @@
 from __future__ import print_function
-import datetime
 import json
 import os
 from shutil import copyfile
 import numpy as np
 import cv2
+import ijson
 import requests
-import math
-from tld import get_tld
-
-from config.app import STORAGE_LOGS_PATH, QUERY_START_PATH, CLUSTER_DATA_PATH, CLUSTER_OUTPUT_PATH
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from itertools import groupby, islice
+from sqlalchemy import Integer, and_, func, inspect, or_
+from sqlalchemy.orm import aliased
+
+from config.app import STORAGE_LOGS_PATH, CLUSTER_DATA_PATH, CLUSTER_OUTPUT_PATH, GREYSCALE_WORKERS, \
+    GREYSCALE_COMPRESSION, CROP_WIDTH, CROP_HEIGHT, HEADER_SCAN_WORKERS, CROP_WORKERS, OVERLAY_WORKERS, OVERLAY_OUTPUTS
 from config.aws import HEADERS
 from config.openai import IMAGE_SIMILARITY_API_KEY, SIMILARITY_THRESHOLD
+from migrations.Fingerprint import Fingerprint
+from migrations.FingerprintPath import FingerprintPath
+from migrations.Job import Job
 from migrations.ParsedResponse import ParsedResponse
 from migrations.Response import Response
 from migrations.Screenshot import Screenshot
 from migrations.Site import Site
 from models.Base import Base, Session, engine
+from models.Collector import Collector
 from models.Driver import Driver
-from models.Screenshot import ScreenshotEnum, to_greyscale
+from models.DriverPool import DriverPool
+from models.JobQueue import JobQueue
+from models.Screenshot import ScreenshotEnum, crop, to_greyscale, write_png
+import services.Domains as Domains
+import services.Log as Log
+import services.Png as Png
+import services.Similarity as Similarity
+from services.ResponseArchive import ResponseArchive
+from services.Time import file_safe_timestamp
+
+log = Log.get(__name__)
+
+# Overlays written into cluster folders by overlay(), which must not be read back as screenshots
+SUBCLUSTER_OUTPUT = re.compile(r'^subcluster\d+(_variance|_heatmap)?\.png$')
+
+# Greyscale value below which overlay's heatmap counts a pixel as content. Screenshots are mostly light backgrounds.
+CONTENT_THRESHOLD = 128
 
 
 def migrate_fresh():
@@ -33,15 +57,88 @@ def migrate_fresh():
     print("Created tables")
 
 
-def query_api_url(count, start):
+def migrate_upgrade(bind=engine):
     """
-    Queries the Alexa API for top sites with a global scope
+    Bring an existing database up to the tables defined by imported migrations while keeping its data. Missing
+    tables, columns and indexes are added. Tables whose columns changed in ways SQLite cannot alter are rebuilt:
+    parsed_responses when its rank and metrics are still strings, converted with to_number as they are copied,
+    responses when its JSON column is still required, and screenshots when its type check does not allow every
+    ScreenshotEnum value. Columns added to existing rows start out empty; fill them with set_domain_columns and
+    scan_dimensions.
+
+    :param bind: Engine of the database to upgrade
+    :return: None
+    """
+    inspector = inspect(bind)
+    tables = set(inspector.get_table_names())
+    columns = {table: {column['name']: column for column in inspector.get_columns(table)} for table in tables}
+
+    with bind.begin() as connection:
+        if 'parsed_responses' in tables and not isinstance(columns['parsed_responses']['rank']['type'], Integer):
+            rebuild_table(connection, ParsedResponse.__table__, lambda row: {
+                **row,
+                'rank': to_number(row['rank'], int),
+                **{metric: to_number(row[metric]) for metric in
+                   ['reach_per_million', 'page_views_per_million', 'page_views_per_user']}
+            })
+            log.info("Rebuilt parsed_responses with typed rank and metrics")
+        if 'responses' in tables and not columns['responses']['response']['nullable']:
+            rebuild_table(connection, Response.__table__)
+            log.info("Rebuilt responses with a nullable response column")
+        if 'screenshots' in tables:
+            # SQLite keeps the enum's CHECK constraint in the stored CREATE TABLE statement only
+            schema = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'screenshots'").scalar()
+            if any(f"'{member.name}'" not in schema for member in ScreenshotEnum):
+                rebuild_table(connection, Screenshot.__table__)
+                log.info("Rebuilt screenshots to allow every screenshot type")
+
+    Base.metadata.create_all(bind)
+
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                                       f"{column.type.compile(dialect=bind.dialect)}")
+                    log.info("Added column %s.%s", table.name, column.name)
+
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    log.info("Created index %s", index.name)
+
+
+def rebuild_table(connection, table, convert=None):
+    """
+    Recreate table as currently defined and copy its rows over, for column changes SQLite cannot make in place
 
-    :param count: Number of sites to return in a response
-    :param start: Index of site to start from according to the Alexa API
-    :return: json
+    :param connection: Connection inside a transaction
+    :param table: sqlalchemy.Table to rebuild
+    :param convert: Optional function from an old row, as a dict, to the new row. Without it, rows are copied in SQL,
+                    so that values such as JSON are moved unchanged.
+    :return: None
     """
-    return f'https://ats.api.alexa.com/api?Action=Topsites&Count={count}&ResponseGroup=Country&Start={start}&Output=json'
+    old = f"{table.name}_old"
+    # Keep foreign keys of other tables pointing at the table name rather than following the rename
+    connection.execute("PRAGMA legacy_alter_table=ON")
+    connection.execute(f"ALTER TABLE {table.name} RENAME TO {old}")
+    connection.execute("PRAGMA legacy_alter_table=OFF")
+    for index in inspect(connection).get_indexes(old):
+        connection.execute(f"DROP INDEX {index['name']}")
+    table.create(connection)
+
+    names = [column['name'] for column in inspect(connection).get_columns(old)
+             if column['name'] in table.columns]
+    if convert is None:
+        connection.execute(f"INSERT INTO {table.name} ({', '.join(names)}) SELECT {', '.join(names)} FROM {old}")
+    else:
+        rows = [convert(dict(row)) for row in connection.execute(f"SELECT {', '.join(names)} FROM {old}")]
+        for start in range(0, len(rows), 10000):
+            connection.execute(table.insert(), rows[start:start + 10000])
+    connection.execute(f"DROP TABLE {old}")
 
 
 def parse_response(data):
@@ -54,120 +151,143 @@ def parse_response(data):
     return data['Ats']['Results']['Result']['Alexa']['TopSites']['Country']['Sites']['Site']
 
 
-def make_api_request(url):
-    """AWS request helper function
+def iter_sites(response, archive=None):
+    """
+    Yield the sites of a stored Response. Archived responses are streamed with an incremental JSON parser, so the
+    document is never loaded whole; responses stored before the archive are read from their JSON column.
 
-    :param url: URL to query from Alexa
-    :return: response
+    :param response: Response row
+    :param archive: ResponseArchive holding the response
+    :return: generator of dicts, as returned by parse_response
     """
-    return requests.get(url, headers=HEADERS)
+    if response.archive_offset is None:
+        yield from parse_response(response.response)
+        return
+
+    archive = archive or ResponseArchive()
+    with archive.open(response.archive_offset, response.archive_length) as f:
+        yield from ijson.items(f, 'Ats.Results.Result.Alexa.TopSites.Country.Sites.Site.item')
 
 
-def log_query_response(data):
+def to_number(value, cast=float):
     """
-    Write query response from Alexa to log file
-    :param data: json data (response) from request
-    :return: None
+    Cast a metric from the Alexa API, which sends numbers as strings, such as '1,234' or '2.5'
+
+    :param value: Value from the response, possibly missing or empty
+    :param cast: int or float
+    :return: The number, or None if there is none
     """
-    filename = f"query_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
-    f.write(json.dumps(data))
-    f.close()
+    if value is None:
+        return None
+    try:
+        return cast(float(str(value).replace(',', '')))
+    except ValueError:
+        return None
 
 
-def file_safe_timestamp():
+def parse_metrics(result):
     """
-    Get the current timestamp that can be written as part of a file name
+    Typed ranking metrics of a single site in a parsed response
 
-    :return: str
+    :param result: Site from parse_response
+    :return: dict of ParsedResponse columns
     """
-    return str(datetime.datetime.now()).replace(" ", "_").replace(".", "-").replace(":", "-")
+    country = result.get('Country') or {}
+    page_views = country.get('PageViews') or {}
+    return {
+        'rank': to_number((result.get('Global') or {}).get('Rank'), int),
+        'reach_per_million': to_number((country.get('Reach') or {}).get('PerMillion')),
+        'page_views_per_million': to_number(page_views.get('PerMillion')),
+        'page_views_per_user': to_number(page_views.get('PerUser'))
+    }
 
 
 def collect_aws_data():
-    session = Session()
-    limit = 1001
-    lower = 1
-    interval = 100
-
-    for i in range(lower, limit, interval):
-        query_start = int(open(QUERY_START_PATH, 'r').readlines()[0])
-        print(f"Querying sites at count {query_start}")
-        if query_start >= limit:
-            print("Exceeded limit")
-            break
-        aws_request_url = query_api_url(start=query_start, count=interval)
-        aws_res = make_api_request(aws_request_url)
-        log_query_response(aws_res.json())
-        response = Response(query=aws_request_url, response=aws_res.json())
-        session.add(response)
-        session.commit()
-        f = open(QUERY_START_PATH, 'w')
-        f.write(str(query_start + interval))
-        f.close()
+    """
+    Collect the top 1000 sites from the Alexa API, fetching several pages at once and skipping pages that are
+    already stored
 
-    session.close()
+    :return: None
+    """
+    failures = Collector(headers=HEADERS).run(lower=1, limit=1001, interval=100)
+    if failures:
+        log.warning("%s pages could not be fetched, run again to resume", failures)
 
 
 def parse_collected_data():
     session = Session()
     data = session.query(Response).filter_by(parsed=False)
 
-    filename = f"parsed_response_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
-
     for site in data:
         response_id = site.id
-        print(f"Beginning response number {response_id}")
-        f.write(f"Beginning response number {response_id} \n")
+        log.info("Beginning response number %s", response_id)
 
-        for response in parse_response(site.response):
+        for response in iter_sites(site):
             url = response['DataUrl']
-            print(f"Beginning site {url}")
-            f.write(f"Beginning site {url}: ")
-            rank = response['Global']['Rank']
-            reach_per_million = response['Country']['Reach']['PerMillion']
-            page_views_per_million = response['Country']['PageViews']['PerMillion']
-            page_views_per_user = response['Country']['PageViews']['PerUser']
-            f.write(
-                f"Rank: {rank}, Reach/Million: {reach_per_million}, Page Views/Million: {page_views_per_million}, Page Views/User: {page_views_per_user} \n")
-            parsed_response = ParsedResponse(response_id=response_id, url=url, rank=rank,
-                                             reach_per_million=reach_per_million,
-                                             page_views_per_million=page_views_per_million,
-                                             page_views_per_user=page_views_per_user)
+            metrics = parse_metrics(response)
+            log.debug("Parsed site %s: %s", url, metrics)
+            parsed_response = ParsedResponse(response_id=response_id, url=url, **metrics)
             session.add(parsed_response)
             session.commit()
 
         session.query(Response).get(response_id).parsed = True
-        print(f"Finished parsing response number {response_id}")
-        f.write(f"Finished parsing response number {response_id} \n\n")
+        log.info("Finished parsing response number %s", response_id)
         session.commit()
 
     session.close()
-    f.close()
 
 
 def convert_parsed_to_site():
     session = Session()
     data = session.query(ParsedResponse).all()
 
-    filename = f"parsed_to_sites_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
-
     for response in data:
-        print(f"Beginning response {response.id}")
-        f.write(f"Beginning response {response.id}: \n")
         split_url = response.url.split(".")
-        site = Site(name='_'.join(split_url), host=response.url)
-        print(f"Parsing site {'_'.join(split_url)} at host {response.url}")
-        f.write(f"Parsing site {'_'.join(split_url)} at host {response.url} \n\n")
+        site = Site(name='_'.join(split_url), host=response.url, **Domains.columns(response.url))
+        log.info("Parsing site %s at host %s", site.name, response.url)
         session.add(site)
         session.commit()
-        print(f"Finished parsing response number {response.id}")
-        f.write(f"Finished parsing response number {response.id} \n\n")
+
+    session.close()
+
+
+def ingest_collected_data():
+    """
+    Parse every unparsed Response straight into ParsedResponse and Site rows. Each Response is ingested with bulk
+    inserts inside a single transaction, instead of the commit per row done by parse_collected_data and
+    convert_parsed_to_site. Hosts that already have a Site are skipped.
+
+    :return: None
+    """
+    session = Session()
+
+    hosts = {host for host, in session.query(Site.host)}
+    names = {name for name, in session.query(Site.name)}
+    response_ids = [response_id for response_id, in session.query(Response.id).filter_by(parsed=False)]
+
+    for response_id in response_ids:
+        response = session.query(Response).get(response_id)
+        parsed_responses = []
+        sites = []
+
+        for result in iter_sites(response):
+            url = result['DataUrl']
+            parsed_responses.append({'response_id': response_id, 'url': url, **parse_metrics(result)})
+
+            name = '_'.join(url.split('.'))
+            if url not in hosts and name not in names:
+                hosts.add(url)
+                names.add(name)
+                sites.append({'name': name, 'host': url, **Domains.columns(url)})
+
+        session.bulk_insert_mappings(ParsedResponse, parsed_responses)
+        session.bulk_insert_mappings(Site, sites)
+        response.parsed = True
+        session.commit()
+        session.expunge(response)
+
+        log.info("Ingested response number %s: %s results, %s new sites", response_id, len(parsed_responses),
+                 len(sites))
 
     session.close()
 
@@ -184,260 +304,327 @@ def __determine_image_sim__(path_one, path_two):
     return r.json()
 
 
-def process_sites():
+Similarity.register_backend('deepai', lambda path: path,
+                            lambda one, two: __determine_image_sim__(one, two)['output']['distance'])
+
+
+def process_sites(workers=None):
+    """
+    Queue a capture job for every unprocessed site and work through the capture queue. By default a fresh browser
+    is booted for each site; passing workers runs the capture through a DriverPool of long-lived browsers instead.
+    Other processes sharing the database can call run_capture_jobs to help drain the same queue.
+
+    :param workers: Number of concurrent browser workers, or None to capture sequentially
+    :return: None
+    """
     session = Session()
+    site_ids = [site_id for site_id, in session.query(Site.id).filter_by(processed=False)]
+    JobQueue(session).enqueue(site_ids)
+    session.close()
 
-    sites = session.query(Site).filter_by(processed=False)
+    run_capture_jobs(workers)
 
-    for site in sites:
-        log_filename = f"screenshot_{file_safe_timestamp()}.log"
-        driver = Driver(log_filename)
-        driver.run(site, session)
-        driver.quit()
 
+def reprocess_failed_sites(workers=None):
+    """
+    Capture every site whose latest capture failed again. Sites that were captured successfully on a later attempt
+    are left alone, and retries are queued behind first captures.
+
+    :param workers: Number of concurrent browser workers, or None to capture sequentially
+    :return: None
+    """
+    session = Session()
+
+    # Derived greyscale and cropped copies are not captures, failed captures have no type
+    latest = session.query(func.max(Screenshot.id).label('id')) \
+        .filter(or_(Screenshot.type == ScreenshotEnum.RGB, Screenshot.type.is_(None))) \
+        .group_by(Screenshot.site_id).subquery()
+    site_ids = [site_id for site_id, in session.query(Screenshot.site_id)
+                .join(latest, latest.c.id == Screenshot.id).filter(Screenshot.failed.is_(True))]
+    JobQueue(session).enqueue(site_ids, priority=-1)
     session.close()
 
+    run_capture_jobs(workers)
+
+
+def run_capture_jobs(workers=None):
+    """
+    Claim and run capture jobs until none are left
 
-def reprocess_failed_sites():
+    :param workers: Number of concurrent browser workers, or None to capture sequentially
+    :return: None
+    """
     session = Session()
+    jobs = JobQueue(session)
+    jobs.reap()
 
-    failed_sites = session.query(Screenshot).filter_by(failed=True)
-    for site in failed_sites:
-        site = session.query(Site).get(site.site_id)
-        log_filename = f"screenshot_{file_safe_timestamp()}.log"
-        driver = Driver(log_filename)
-        driver.run(site, session)
+    if workers:
+        session.close()
+        DriverPool(workers).run()
+        return
+
+    while True:
+        job = jobs.claim()
+        if job is None:
+            break
+
+        driver = Driver()
+        if driver.run(session.query(Site).get(job.site_id), session):
+            jobs.complete(job)
+        else:
+            jobs.fail(job, driver.error)
         driver.quit()
 
     session.close()
 
 
-def convert_site_colorspace():
-    filename = f"convert_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
+def convert_site_colorspace(workers=GREYSCALE_WORKERS, compression=GREYSCALE_COMPRESSION):
+    """
+    Write a greyscale copy of the first RGB screenshot of every site that does not have one yet. The pending
+    screenshots are found with one anti-join, converted in parallel by a process pool and recorded with bulk
+    inserts as conversions complete.
 
+    :param workers: Number of conversion processes
+    :param compression: PNG compression level of the greyscale copies, 0-9
+    :return: None
+    """
     session = Session()
-    screenshots = session.query(Screenshot).filter_by(type=ScreenshotEnum.RGB)
-    for screenshot in screenshots:
-        sc_check = session.query(Screenshot).filter_by(site_id=screenshot.site_id)
-        flag = False
-        for sc in sc_check:
-            if sc.type == ScreenshotEnum.GREYSCALE:
-                print('Found greyscale version of screenshot.')
-                f.write(f"Found greyscale version of screenshot. Skipping (id={sc.id})\n\n")
-
-                flag = True
-        if flag:
-            pass
-        else:
-            site_name = session.query(Site).get(screenshot.site_id).name
-
-            print(f"Converting screenshot of site {site_name} from RGB to GREYSCALE")
-            f.write(f"Converting screenshot of site {site_name} from RGB to GREYSCALE \n")
+    greyscale = aliased(Screenshot)
+    rows = session.query(Screenshot.site_id, Screenshot.path, Site.name) \
+        .join(Site, Site.id == Screenshot.site_id) \
+        .outerjoin(greyscale, and_(greyscale.site_id == Screenshot.site_id,
+                                   greyscale.type == ScreenshotEnum.GREYSCALE)) \
+        .filter(Screenshot.type == ScreenshotEnum.RGB, Screenshot.path.isnot(None), greyscale.id.is_(None)) \
+        .order_by(Screenshot.id)
+
+    pending = {}
+    for site_id, path, name in rows:
+        pending.setdefault(site_id, (path, name))
+
+    log.info("Converting %s screenshots from RGB to GREYSCALE with %s workers", len(pending), workers)
+
+    converted = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(to_greyscale, path, name, compression): (site_id, name)
+                   for site_id, (path, name) in pending.items()}
+        for future in as_completed(futures):
+            site_id, name = futures[future]
+            try:
+                converted.append({'site_id': site_id, 'type': ScreenshotEnum.GREYSCALE, 'path': future.result()})
+            except Exception as e:
+                log.error("Failed conversion of %s: %s", name, e)
+                continue
+
+            log.info("Finished conversion of %s from RGB to GREYSCALE", name)
+
+            if len(converted) >= 100:
+                session.bulk_insert_mappings(Screenshot, converted)
+                session.commit()
+                converted = []
+
+    session.bulk_insert_mappings(Screenshot, converted)
+    session.commit()
+    session.close()
 
-            path = to_greyscale(screenshot.path, site_name)
-            greyscale_screenshot = Screenshot(site_id=screenshot.site_id, type=ScreenshotEnum.GREYSCALE, path=path)
-            session.add(greyscale_screenshot)
-            session.commit()
 
-            print(f"Finished conversion of {site_name} from RGB to GREYSCALE")
-            f.write(f"Finished conversion of {site_name} from RGB to GREYSCALE \n\n")
+def scan_dimensions(workers=HEADER_SCAN_WORKERS, type=None):
+    """
+    Fill the width and height of every screenshot that does not have them yet from its PNG header, without
+    decoding any pixels. Copies in CLUSTER_DATA_PATH are first matched to their CLUSTER_DATA screenshots.
 
+    :param workers: Number of header reader threads
+    :param type: Only scan screenshots of this ScreenshotEnum type
+    :return: None
+    """
+    session = Session()
+    if type in (None, ScreenshotEnum.CLUSTER_DATA):
+        record_cluster_data(session)
+
+    screenshots = session.query(Screenshot.id, Screenshot.path) \
+        .filter(Screenshot.path.isnot(None), Screenshot.width.is_(None))
+    if type is not None:
+        screenshots = screenshots.filter(Screenshot.type == type)
+    screenshots = screenshots.all()
+    headers = Png.read_headers([path for _, path in screenshots], workers)
+
+    session.bulk_update_mappings(Screenshot, [
+        {'id': screenshot_id, 'width': headers[path].width, 'height': headers[path].height}
+        for screenshot_id, path in screenshots if headers[path] is not None
+    ])
+    session.commit()
     session.close()
 
 
-def __set_domain_keys__(delimited_list):
-    domains = {}
-    for site in delimited_list[1]:
-        domains.update({site.split('.')[0]: []})
+def record_cluster_data(session):
+    """
+    Match the copies in CLUSTER_DATA_PATH to CLUSTER_DATA screenshots by site name, adding rows for copies that
+    copy_unique_screenshots did not record and deleting rows whose copy is gone
 
-    for site in delimited_list[2]:
-        tld = get_tld(site, fix_protocol=True)
-        if len(tld.split('.')) == 2:
-            domains.update({site.split('.')[0]: []})
+    :param session: Session to record the changes in, committed on return
+    :return: None
+    """
+    paths = {f"{CLUSTER_DATA_PATH}/{image}" for image in os.listdir(CLUSTER_DATA_PATH) if image.endswith('.png')}
+    recorded = dict(session.query(Screenshot.path, Screenshot.id).filter_by(type=ScreenshotEnum.CLUSTER_DATA))
+    sites = dict(session.query(Site.name, Site.id))
+
+    added = []
+    for path in sorted(paths - recorded.keys()):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in sites:
+            added.append({'site_id': sites[name], 'path': path, 'type': ScreenshotEnum.CLUSTER_DATA})
         else:
-            subdomain = site.split('.')[0]
-            domain = site.split('.')[1]
-            key = '.'.join([subdomain, domain])
-            domains.update({key: []})
-
-    for site in delimited_list[3]:
-        subdomain = site.split('.')[0]
-        domain = site.split('.')[1]
-        key = '.'.join([subdomain, domain])
-        domains.update({key: []})
-
-    return domains
-
-
-def find_dimension_constraints():
-    height = 50000
-    width = 50000
-    filename = f"crop_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
-    f.write(f"Initializing constraints using dimensions [height: {height}] and [width: {width}]\n")
-    for image in os.listdir(CLUSTER_DATA_PATH):
-        if image.endswith('.png'):
-            image_name = image
-            f.write(f"Checking screenshot {image_name}\n")
-            image = cv2.imread(f"{CLUSTER_DATA_PATH}/{image_name}")
-
-            h = image.shape[0]
-            w = image.shape[1]
-            f.write(f"Height: {h}, width: {w}\n")
-            if h < height:
-                f.write(
-                    f"{image_name} height is smaller than maximum constraint {height}, setting new constraint to {h}\n")
-                height = h
-            if w < width:
-                f.write(
-                    f"{image_name} height is smaller than maximum constraint {width}, setting new constraint to {w}\n")
-                width = w
-
-    print(height, width)
-    f.write(f"Height: {height}, width: {height}")
-    f.close()
+            log.warning("No site named %s, leaving out %s", name, path)
+    session.bulk_insert_mappings(Screenshot, added)
 
+    removed = [screenshot_id for path, screenshot_id in recorded.items() if path not in paths]
+    for start in range(0, len(removed), 500):
+        session.query(Screenshot).filter(Screenshot.id.in_(removed[start:start + 500])) \
+            .delete(synchronize_session=False)
+    session.commit()
+    log.info("Recorded %s new copies in %s, removed %s", len(added), CLUSTER_DATA_PATH, len(removed))
 
-def set_image_dimensions():
-    height = 1440
-    width = 2560
-    filename = f"crop_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
-    f.write(f"Using dimensions [height: {height}] and [width: {width}]\n")
-    for image in os.listdir(CLUSTER_DATA_PATH):
-        if image.endswith('.png'):
-            image_name = image
-            f.write(f"Checking screenshot {image_name}")
-            image = cv2.imread(f"{CLUSTER_DATA_PATH}/{image_name}")
-            if image.shape[0] > height:
-                f.write(f"{image_name} exceeds height, cropping\n")
-                image = image[0:height, 0:image.shape[1]]
-            if image.shape[1] > width:
-                f.write(f"{image_name} exceeds width, cropping\n")
-                image = image[0:image.shape[0], 0:width]
-
-            cv2.imwrite(f"{CLUSTER_DATA_PATH}/{image_name}", image)
-            f.write(f"Finished {image_name} \n\n")
-    f.close()
 
+def find_dimension_constraints(workers=HEADER_SCAN_WORKERS):
+    """
+    Smallest height and width among the screenshots in CLUSTER_DATA_PATH, queried from their CLUSTER_DATA rows.
+    Only copies whose dimensions are not recorded yet have their PNG headers read.
 
-def __set_domain_values__(domains, delimited_list):
-    for site in delimited_list[1]:
-        domains[site.split('.')[0]].append(site)
+    :param workers: Number of header reader threads
+    :return: tuple of height and width
+    """
+    scan_dimensions(workers, ScreenshotEnum.CLUSTER_DATA)
 
-    for site in delimited_list[2]:
-        tld = get_tld(site, fix_protocol=True)
-        if len(tld.split('.')) == 2:
-            domains[site.split('.')[0]].append(site)
-        else:
-            domains['.'.join([site.split('.')[0], site.split('.')[1]])].append(site)
+    session = Session()
+    count, height, width = session.query(func.count(Screenshot.id), func.min(Screenshot.height),
+                                         func.min(Screenshot.width)) \
+        .filter(Screenshot.type == ScreenshotEnum.CLUSTER_DATA, Screenshot.width.isnot(None)).one()
+    session.close()
+
+    log.info("Checked %s screenshots. Height: %s, width: %s", count, height, width)
+    return height, width
 
-    for site in delimited_list[3]:
-        domains['.'.join([site.split('.')[0], site.split('.')[1]])].append(site)
 
-    return domains
+def set_image_dimensions(workers=CROP_WORKERS):
+    """
+    Crop every screenshot in CLUSTER_DATA_PATH to at most CROP_WIDTH x CROP_HEIGHT. The copies that need cropping
+    are queried from their recorded dimensions; each is cropped in a process pool to a temporary file that replaces
+    the original once complete, and its new dimensions are recorded.
 
+    :param workers: Number of cropping processes
+    :return: None
+    """
+    height = CROP_HEIGHT
+    width = CROP_WIDTH
+    log.info("Using dimensions [height: %s] and [width: %s]", height, width)
 
-def insertion_sort(arr):
-    for i in range(len(arr)):
-        cursor = arr[i]
-        pos = i
+    scan_dimensions(HEADER_SCAN_WORKERS, ScreenshotEnum.CLUSTER_DATA)
 
-        while pos > 0 and arr[pos - 1] > cursor:
-            # Swap the number down the list
-            arr[pos] = arr[pos - 1]
-            pos = pos - 1
-        # Break and do the final swap
-        arr[pos] = cursor
+    session = Session()
+    copies = session.query(Screenshot.id, Screenshot.path).filter_by(type=ScreenshotEnum.CLUSTER_DATA)
+    total = copies.count()
+    # Copies without dimensions have unreadable headers and are decoded instead
+    pending = copies.filter(or_(Screenshot.width.is_(None), Screenshot.height > height,
+                                Screenshot.width > width)).all()
+    log.info("Cropping %s of %s screenshots, the rest are within bounds", len(pending), total)
+
+    cropped = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(crop, path, width, height): (screenshot_id, path)
+                   for screenshot_id, path in pending}
+        for future in as_completed(futures):
+            screenshot_id, path = futures[future]
+            try:
+                h, w = future.result()
+                log.debug("Cropped %s to [height: %s] and [width: %s]", path, h, w)
+                cropped.append({'id': screenshot_id, 'width': w, 'height': h})
+            except Exception as e:
+                log.error("Failed to crop %s: %s", path, e)
+
+    session.bulk_update_mappings(Screenshot, cropped)
+    session.commit()
+    session.close()
 
-    return arr
 
+def set_domain_columns():
+    """
+    Fill the precomputed domain columns of every Site that does not have them yet
 
-def identify_layout_duplicates():
-    filename = f"id_layout_duplicates_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
-    f.write(
-        f"Layout duplication identification function, using threshold {SIMILARITY_THRESHOLD} for distance in image similarity")
+    :return: None
+    """
     session = Session()
+    sites = session.query(Site.id, Site.host).filter(Site.domain_key.is_(None)).all()
+    session.bulk_update_mappings(Site, [{'id': site_id, **Domains.columns(host)} for site_id, host in sites])
+    session.commit()
+    session.close()
 
-    sites = session.query(Site).order_by(Site.host)
-
-    list_by_delimiters = {
-        1: [],
-        2: [],
-        3: []
-    }
-    f.write(f"Initialize list by delimiters: {list_by_delimiters}\n\n")
 
-    for site in sites:
-        delimiter_count = site.host.count('.')
-        list_by_delimiters[delimiter_count].append(site.host)
-    f.write(f"Updated list by delimiters: {list_by_delimiters}\n\n")
+def identify_layout_duplicates():
+    log.info("Identifying layout duplicates, using threshold %s for distance in image similarity",
+             SIMILARITY_THRESHOLD)
+    session = Session()
 
-    domains = __set_domain_keys__(list_by_delimiters)
-    f.write(f"Domains by keys: {domains}\n\n")
-    domains = __set_domain_values__(domains, list_by_delimiters)
-    f.write(f"Domains with values: {domains}\n\n")
+    set_domain_columns()
+
+    # Every site with its first screenshot path and best Alexa rank in one query, ordered by the indexed grouping
+    # key so that each group of TLD variants arrives together, highest ranked first
+    first_screenshot = session.query(Screenshot.site_id, func.min(Screenshot.id).label('id')) \
+        .filter(Screenshot.path.isnot(None)).group_by(Screenshot.site_id).subquery()
+    best_rank = session.query(ParsedResponse.url, func.min(ParsedResponse.rank).label('rank')) \
+        .group_by(ParsedResponse.url).subquery()
+    rows = session.query(Site.domain_key, Site.id, Site.host, Screenshot.path) \
+        .outerjoin(first_screenshot, first_screenshot.c.site_id == Site.id) \
+        .outerjoin(Screenshot, Screenshot.id == first_screenshot.c.id) \
+        .outerjoin(best_rank, best_rank.c.url == Site.host) \
+        .order_by(Site.domain_key, best_rank.c.rank.is_(None), best_rank.c.rank, Site.id)
+
+    hosts = {}
+    paths = {}
+    domains = {}
+    for key, group in groupby(rows, key=lambda row: row.domain_key):
+        domains[key] = []
+        for _, site_id, host, path in group:
+            hosts[site_id] = host
+            if path is not None:
+                paths[site_id] = path
+            domains[key].append(site_id)
+    session.close()
+    log.debug("Domains with values: %s", domains)
 
     unique_domains = []
 
-    pre_filter_count = 0
-    for domains in domains.values():
-        pre_filter_count += len(domains)
-        if len(domains) == 1:
-            print(f"Unique domain {domains[0]}")
-            f.write(f"Unique domain {domains[0]}\n")
-            unique_domains.append(domains[0])
-        elif len(domains) == 0:
-            print("No domain found, skipping")
-            f.write("No domain found, skipping\n")
-        else:
-            filtered_domains = []
-            for domain in domains:
-                filtered_domains.append(session.query(Site).filter_by(host=domain).first().id)
-
-            # Make sure that the filtered domains are sorted
-            filtered_domains = insertion_sort(filtered_domains)
-            unique_domains.append(session.query(Site).filter_by(id=filtered_domains[0]).first().host)
-            base_domain = filtered_domains[0]
-            print(f"Base domain {base_domain}\n")
-            f.write(f"Base domain {base_domain}\n")
-            base_domain_path = session.query(Screenshot).filter_by(site_id=base_domain).first().path
-            for i in range(1, len(filtered_domains)):
-                response = __determine_image_sim__(base_domain_path, session.query(Screenshot).filter_by(
-                    site_id=filtered_domains[i]).first().path)
-                parsed = json.loads(json.dumps(response))
-                distance = parsed['output']['distance']
-                print(f"Similarity distance: {distance}\n")
-                f.write(f"Similarity distance: {distance}\n")
-                if int(distance) < int(SIMILARITY_THRESHOLD):
-                    pass
-                else:
-                    host = session.query(Site).filter_by(id=filtered_domains[i]).first().host
-                    print(f"Appending host {host}\n")
-                    f.write(f"Appending host {host}\n")
-                    unique_domains.append(host)
+    pre_filter_count = len(hosts)
+    for site_ids in domains.values():
+        if len(site_ids) == 1:
+            log.debug("Unique domain %s", hosts[site_ids[0]])
+            unique_domains.append(hosts[site_ids[0]])
+            continue
+
+        # The highest ranked site is kept as the base
+        base_domain = site_ids[0]
+        unique_domains.append(hosts[base_domain])
+        log.debug("Base domain %s", hosts[base_domain])
+        for site_id in site_ids[1:]:
+            if base_domain not in paths or site_id not in paths:
+                log.info("Missing screenshot, keeping host %s", hosts[site_id])
+                unique_domains.append(hosts[site_id])
+                continue
+
+            distance = Similarity.distance(paths[base_domain], paths[site_id])
+            log.debug("Similarity distance between %s and %s: %s", hosts[base_domain], hosts[site_id], distance)
+            if int(distance) >= int(SIMILARITY_THRESHOLD):
+                log.debug("Appending host %s", hosts[site_id])
+                unique_domains.append(hosts[site_id])
 
     post_filter_count = len(unique_domains)
-    print(f"Pre filter count: {pre_filter_count}\n")
-    f.write(f"Pre filter count: {pre_filter_count}\n")
-    print(f"Post filter count: {post_filter_count}\n")
-    f.write(f"Post filter count: {post_filter_count}\n")
-    session.close()
-    f.close()
+    log.info("Pre filter count: %s, post filter count: %s", pre_filter_count, post_filter_count)
 
+    # The list of unique domains is an input of copy_unique_screenshots, so it stays a plain file
     filename = f"unique_domains_{file_safe_timestamp()}.log"
-    f = open(f"{STORAGE_LOGS_PATH}/{filename}", "x")
-    f.write(str(datetime.datetime.now()) + "\n\n")
-    for d in unique_domains:
-        f.write(f"{d}\n")
-    print(unique_domains)
-    f.close()
+    with open(f"{STORAGE_LOGS_PATH}/{filename}", "x") as f:
+        for d in unique_domains:
+            f.write(f"{d}\n")
+    log.info("Wrote %s unique domains to %s", post_filter_count, filename)
+    log.debug("Unique domains: %s", unique_domains)
     return unique_domains
 
 
@@ -460,84 +647,183 @@ def copy_unique_screenshots():
     filename = 'unique_domains.log'
     session = Session()
     f = open(f'{STORAGE_LOGS_PATH}/{filename}', 'r')
-    log_filename = f"copy_unique_screenshots_{file_safe_timestamp()}.log"
-    log = open(f"{STORAGE_LOGS_PATH}/{log_filename}", "x")
-    log.write(str(datetime.datetime.now()) + "\n\n")
     unique_domains = f.readlines()
     for domain in unique_domains:
         if domain.endswith('\n'):
             domain = domain[0:len(domain) - 1]
 
-        print(f"Domain {domain}")
-        log.write(f"Domain {domain}\n")
         site = session.query(Site).filter_by(host=domain).first()
-        screenshot = session.query(Screenshot).filter_by(type=ScreenshotEnum.GREYSCALE,
-                                                         site_id=site.id).first()
-        copyfile(screenshot.path, f"{CLUSTER_DATA_PATH}/{site.name}.png")
-        print(f"Copied greyscale screenshot to {CLUSTER_DATA_PATH}/{site.name}.png")
-        log.write(f"Copied greyscale screenshot to {CLUSTER_DATA_PATH}/{site.name}.png\n")
+        # Copies cropped at capture time already fit the clustering dimensions
+        screenshot = session.query(Screenshot).filter_by(type=ScreenshotEnum.CROPPED, site_id=site.id).first() or \
+            session.query(Screenshot).filter_by(type=ScreenshotEnum.GREYSCALE, site_id=site.id).first()
+        path = f"{CLUSTER_DATA_PATH}/{site.name}.png"
+        copyfile(screenshot.path, path)
+        copy = session.query(Screenshot).filter_by(type=ScreenshotEnum.CLUSTER_DATA, site_id=site.id).first() or \
+            Screenshot(site_id=site.id, type=ScreenshotEnum.CLUSTER_DATA)
+        copy.path = path
+        # Dimensions the source does not have yet are filled in by scan_dimensions
+        copy.width, copy.height = screenshot.width, screenshot.height
+        session.add(copy)
+        log.info("Copied screenshot of %s to %s", domain, path)
     f.close()
-    print("Finished copying screenshots")
-    log.write("Finished copying screenshots\n\n")
-    log.close()
+    session.commit()
+    session.close()
+    log.info("Finished copying screenshots")
+
+
+def overlay_images(workers=OVERLAY_WORKERS, outputs=OVERLAY_OUTPUTS, resume=True):
+    """
+    Overlay every subcluster of up to 50 screenshots in each cluster, processing subclusters in parallel. Clusters
+    and subclusters are produced lazily and only a few subclusters are queued ahead of the workers. Screenshots
+    that are not CROP_HEIGHT tall, going by their recorded dimensions, are left out.
+
+    :param workers: Number of overlay processes
+    :param outputs: Images to write per subcluster, any of 'mean', 'variance' and 'heatmap'
+    :param resume: Skip subclusters whose outputs were all written by a previous run. Subclusters are cut from the
+                   sorted file names, so they only line up with the previous run while the clusters are unchanged.
+    :return: None
+    """
+    # Cluster folders hold copies of the screenshots in CLUSTER_DATA_PATH under the same file names
+    scan_dimensions(type=ScreenshotEnum.CLUSTER_DATA)
+    session = Session()
+    heights = {os.path.basename(path): height for path, height in
+               session.query(Screenshot.path, Screenshot.height).filter_by(type=ScreenshotEnum.CLUSTER_DATA)}
+    session.close()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for cluster_path in cluster_folders():
+            names = cluster_screenshots(cluster_path)
+            kept = [name for name in names if heights.get(name) == CROP_HEIGHT]
+            if len(kept) < len(names):
+                log.info("Leaving out %s screenshots of %s that are not %spx tall", len(names) - len(kept),
+                         cluster_path, CROP_HEIGHT)
 
+            for j, items in enumerate(subclusters(kept, 50)):
+                if resume and all(os.path.exists(path) for path in overlay_paths(cluster_path, j, outputs).values()):
+                    log.info("Subcluster %s of %s already overlaid, skipping", j, cluster_path)
+                    continue
 
-def overlay_images():
-    clusters = os.listdir(CLUSTER_OUTPUT_PATH)
-    i = 0
-    for cluster in clusters:
-        cluster_path = f"{CLUSTER_OUTPUT_PATH}/{cluster}"
-        cluster_items = os.listdir(cluster_path)
+                pending.add(executor.submit(overlay, cluster_path, items, j, outputs))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
 
-        subcluster_items = subclusters(cluster_items, 50)
-        j=0
-        for i in subcluster_items:
-            overlay(cluster_path, i, j)
-            j += 1
+        for future in as_completed(pending):
+            future.result()
 
-        # overlay(cluster_path, cluster_items)
+
+def cluster_folders():
+    """
+    Yield the folder of every cluster in CLUSTER_OUTPUT_PATH
+
+    :return: generator of str
+    """
+    with os.scandir(CLUSTER_OUTPUT_PATH) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield f"{CLUSTER_OUTPUT_PATH}/{entry.name}"
+
+
+def cluster_screenshots(cluster_path):
+    """
+    Sorted file names of the screenshots in a cluster folder, leaving out subcluster overlays written by earlier
+    runs and unfinished temporary files
+
+    :param cluster_path: Folder of the cluster
+    :return: list of str
+    """
+    with os.scandir(cluster_path) as entries:
+        return sorted(entry.name for entry in entries
+                      if entry.name.endswith('.png') and not SUBCLUSTER_OUTPUT.match(entry.name))
 
 
 def subclusters(cluster_items, limit):
-    clusters = []
-    count = 0
-    index = 0
-    for i in range(0,  math.ceil(len(cluster_items)/limit)):
-        clusters.append([])
-        for j in range(index, len(cluster_items)):
-            if count == limit:
-                count = 0
-                break
-
-            clusters[i].append(cluster_items[index])
-            index += 1
-            count += 1
-    return clusters
-
-
-def overlay(cluster_path, cluster_items, subcluster_count):
-    image = cv2.cvtColor(cv2.imread(f"{cluster_path}/{cluster_items[0]}"), cv2.COLOR_BGR2GRAY)
-    for i in range(1, len(cluster_items)):
-        image_0 = image
-        image_1 = cv2.cvtColor(cv2.imread(f"{cluster_path}/{cluster_items[i]}"), cv2.COLOR_BGR2GRAY)
-
-        # 0 is width, 1 is height
-        image_0_dimensions = [image_0.shape[1], image_0.shape[0]]
-        image_1_dimensions = [image_1.shape[1], image_1.shape[0]]
-
-        if image_1_dimensions[1] != 1440:
-            os.remove(f"{cluster_path}/{cluster_items[i]}")
-        else:
-            if image_0_dimensions[0] != image_1_dimensions[0]:
-                if image_0_dimensions[0] < image_1_dimensions[0]:
-                    image_1 = cv2.resize(image_1, (image_0_dimensions[0], image_0_dimensions[1]))
-                else:
-                    image_0 = cv2.resize(image_0, (image_1_dimensions[0], image_1_dimensions[1]))
+    """
+    Yield consecutive lists of at most limit items
+
+    :param cluster_items: Any iterable, consumed lazily
+    :param limit: Size of each list
+    :return: generator of lists
+    """
+    items = iter(cluster_items)
+    while True:
+        chunk = list(islice(items, limit))
+        if not chunk:
+            return
+        yield chunk
+
 
-            image = cv2.addWeighted(image_0, 0.5, image_1, 0.5, 0)
+def overlay_paths(cluster_path, subcluster_count, outputs):
+    """
+    Paths of the images overlay writes for a subcluster
+
+    :return: dict of output name to path
+    """
+    suffixes = {'mean': '', 'variance': '_variance', 'heatmap': '_heatmap'}
+    return {output: f"{cluster_path}/subcluster{subcluster_count}{suffixes[output]}.png" for output in outputs}
+
+
+def overlay(cluster_path, cluster_items, subcluster_count, outputs=OVERLAY_OUTPUTS):
+    """
+    Average the screenshots of a subcluster with equal weights. Images are decoded straight to greyscale and summed
+    into a float32 accumulator, so memory stays at two buffers however many images there are. Images of another
+    size are resized to the first one. Input files are only read. The variance and heatmap outputs each add one
+    more accumulator of the same size.
+
+    :param cluster_path: Folder of the cluster
+    :param cluster_items: File names of the subcluster's screenshots
+    :param subcluster_count: Index of the subcluster, used in the output file names
+    :param outputs: Images to write: 'mean' to subcluster{n}.png, 'variance' (per pixel standard deviation, scaled to
+                    0-255) to subcluster{n}_variance.png and 'heatmap' (the share of images in which each pixel is
+                    darker than CONTENT_THRESHOLD, coloured) to subcluster{n}_heatmap.png. Each is written to a
+                    temporary file first, so an interrupted run leaves no partial outputs behind.
+    :return: list of written paths
+    """
+    total = None
+    squares = None
+    content = None
+    count = 0
+    for item in cluster_items:
+        path = f"{cluster_path}/{item}"
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            log.warning("Skipping %s, could not read it", path)
+            continue
+        if total is None:
+            total = np.zeros(image.shape, dtype=np.float32)
+            squares = np.zeros(image.shape, dtype=np.float32) if 'variance' in outputs else None
+            content = np.zeros(image.shape, dtype=np.float32) if 'heatmap' in outputs else None
+        elif image.shape != total.shape:
+            image = cv2.resize(image, (total.shape[1], total.shape[0]))
+
+        if content is not None:
+            content += image < CONTENT_THRESHOLD
+        image = image.astype(np.float32)
+        total += image
+        if squares is not None:
+            squares += image * image
+        count += 1
+
+    if count == 0:
+        log.warning("No screenshots to overlay in subcluster %s of %s", subcluster_count, cluster_path)
+        return []
+
+    mean = total / count
+    paths = overlay_paths(cluster_path, subcluster_count, outputs)
+    if 'mean' in outputs:
+        write_png(paths['mean'], np.rint(mean).astype(np.uint8))
+    if 'variance' in outputs:
+        deviation = np.sqrt(np.maximum(squares / count - mean * mean, 0))
+        write_png(paths['variance'], cv2.normalize(deviation, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8))
+    if 'heatmap' in outputs:
+        write_png(paths['heatmap'], cv2.applyColorMap(np.rint(content * (255 / count)).astype(np.uint8),
+                                                      cv2.COLORMAP_JET))
+
+    log.info("Layered %s images of subcluster %s in %s", count, subcluster_count, cluster_path)
+    return list(paths.values())
 
-    cv2.imwrite(f"{cluster_path}/subcluster{subcluster_count}.png", image)
-    print("Layered image finished")
 
 def parse_results(results):
     variants = [
@@ -0,0 +1,19 @@
+from sqlalchemy import Column, ForeignKey, Integer, LargeBinary, String
+from sqlalchemy.orm import relationship, backref
+
+from models.Base import Base
+
+
+class Fingerprint(Base):
+    __tablename__ = 'fingerprints'
+
+    id = Column(Integer, primary_key=True)
+    screenshot_id = Column(Integer, ForeignKey('screenshots.id', ondelete='CASCADE'), nullable=True)
+    content_hash = Column(String(40), unique=True, nullable=False)
+    width = Column(Integer)
+    height = Column(Integer)
+    phash = Column(String(16))
+    dhash = Column(String(16))
+    thumbnail = Column(LargeBinary)
+    feature = Column(LargeBinary)
+    parent = relationship('Screenshot', backref=backref('fingerprint', cascade='all,delete', passive_deletes=True))
@@ -0,0 +1,12 @@
+from sqlalchemy import Column, Float, Integer, String
+
+from models.Base import Base
+
+
+class FingerprintPath(Base):
+    __tablename__ = 'fingerprint_paths'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, unique=True, nullable=False)
+    mtime = Column(Float, nullable=False)
+    content_hash = Column(String(40), index=True, nullable=False)
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, DateTime, Enum, ForeignKey, Index, Integer, String, Text
+from sqlalchemy.orm import relationship, backref
+
+from models.Base import Base
+from models.Job import JobKind, JobState
+
+
+class Job(Base):
+    __tablename__ = 'jobs'
+    __table_args__ = (Index('ix_jobs_claim', 'kind', 'state', 'priority'),)
+
+    id = Column(Integer, primary_key=True)
+    site_id = Column(Integer, ForeignKey('sites.id', ondelete='CASCADE'), index=True)
+    kind = Column(Enum(JobKind), nullable=False)
+    state = Column(Enum(JobState), nullable=False)
+    priority = Column(Integer, default=0, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, nullable=False)
+    worker = Column(String(255))
+    lease_expires = Column(DateTime)
+    error = Column(Text)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    parent = relationship('Site', backref=backref('jobs', cascade='all,delete', passive_deletes=True))
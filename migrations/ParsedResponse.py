@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Float, Integer, String, ForeignKey
 from sqlalchemy.orm import relationship, backref
 
 from models.Base import Base
@@ -9,9 +9,9 @@ class ParsedResponse(Base):
 
     id = Column(Integer, primary_key=True)
     response_id = Column(Integer, ForeignKey('responses.id', ondelete='CASCADE'))
-    url = Column(String, nullable=False)
-    rank = Column(String, nullable=True)
-    reach_per_million = Column(String, nullable=True)
-    page_views_per_million = Column(String, nullable=True)
-    page_views_per_user = Column(String, nullable=True)
+    url = Column(String, nullable=False, index=True)
+    rank = Column(Integer, nullable=True, index=True)
+    reach_per_million = Column(Float, nullable=True)
+    page_views_per_million = Column(Float, nullable=True)
+    page_views_per_user = Column(Float, nullable=True)
     parent = relationship('Response', backref=backref('parsed_response', cascade='all,delete', passive_deletes=True))
@@ -9,7 +9,11 @@ class Response(Base):
 
     id = Column(Integer, primary_key=True)
     query = Column(String, nullable=False)
-    response = Column(JSON, nullable=False)
-    parsed = Column(Boolean, default=False)
+    start = Column(Integer, unique=True)
+    # Responses collected before the archive hold their JSON here, later ones are read from the response archive
+    response = Column(JSON, nullable=True)
+    archive_offset = Column(Integer)
+    archive_length = Column(Integer)
+    parsed = Column(Boolean, default=False, index=True)
     children = relationship('ParsedResponse', backref='response', cascade='all,delete')
 
@@ -9,11 +9,15 @@ class Screenshot(Base):
     __tablename__ = 'screenshots'
 
     id = Column(Integer, primary_key=True)
-    site_id = Column(Integer, ForeignKey('sites.id', ondelete='CASCADE'))
+    site_id = Column(Integer, ForeignKey('sites.id', ondelete='CASCADE'), index=True)
     path = Column(String)
-    type = Column(Enum(ScreenshotEnum))
+    type = Column(Enum(ScreenshotEnum), index=True)
+    width = Column(Integer)
+    height = Column(Integer)
     scroll_height = Column(Integer)
     time_elapsed = Column(String)
     exceeded_height = Column(Boolean, default=False)
     failed = Column(Boolean, default=False)
+    round_trips = Column(Integer)
+    tiled = Column(Boolean, default=False)
     parent = relationship('Site', backref=backref('screenshot', cascade='all,delete', passive_deletes=True))
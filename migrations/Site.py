@@ -10,5 +10,11 @@ class Site(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(255), unique=True, nullable=False)
     host = Column(String(255), unique=True, nullable=False)
-    processed = Column(Boolean, default=False)
+    processed = Column(Boolean, default=False, index=True)
+    subdomain = Column(String(255))
+    root_domain = Column(String(255), index=True)
+    suffix = Column(String(255))
+    domain_key = Column(String(255), index=True)
+    geo_tld = Column(Boolean)
+    cluster = Column(Integer, nullable=True, index=True)
     children = relationship('Screenshot', backref='site', cascade='all,delete')
@@ -1,9 +1,45 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.session import sessionmaker
-from config.database import conn_string
+from sqlalchemy.pool import NullPool
 
-engine = create_engine(conn_string)
+from config.database import conn_string, sqlite_journal_mode, sqlite_synchronous, sqlite_busy_timeout
+
+
+def create_database_engine(url=conn_string, journal_mode=sqlite_journal_mode, synchronous=sqlite_synchronous,
+                           busy_timeout=sqlite_busy_timeout):
+    """
+    Create an engine for url. SQLite connections get the configured journal mode, synchronous level and busy timeout.
+    They are not pooled: opening a SQLite connection is cheap, and unpooled connections can never be shared between
+    a process and the workers it forks or between threads. Other databases get a regular pool that checks
+    connections before handing them out.
+
+    :param url: Database URL
+    :param journal_mode: SQLite journal mode, such as 'WAL' or 'DELETE', or None to leave the database's own
+    :param synchronous: SQLite synchronous level, such as 'NORMAL' or 'FULL', or None for the default
+    :param busy_timeout: Seconds a SQLite connection waits for a lock before failing
+    :return: sqlalchemy.engine.Engine
+    """
+    if not url.startswith('sqlite'):
+        return create_engine(url, pool_pre_ping=True)
+
+    engine = create_engine(url, poolclass=NullPool,
+                           connect_args={'timeout': busy_timeout, 'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def configure(connection, record):
+        cursor = connection.cursor()
+        if journal_mode:
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        if synchronous:
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        cursor.close()
+
+    return engine
+
+
+engine = create_database_engine()
 Session = sessionmaker(bind=engine)
 
 Base = declarative_base()
@@ -0,0 +1,121 @@
+import asyncio
+import random
+from urllib.parse import parse_qs, urlparse
+
+import aiohttp
+
+from config.app import ALEXA_API_URL, QUERY_BACKOFF, QUERY_CONCURRENCY, QUERY_RETRIES
+from migrations.Response import Response
+from models.Base import Session
+from services.ResponseArchive import ResponseArchive
+import services.Log as Log
+
+log = Log.get(__name__)
+
+
+def query_api_url(count, start, base_url=ALEXA_API_URL):
+    """
+    Queries the Alexa API for top sites with a global scope
+
+    :param count: Number of sites to return in a response
+    :param start: Index of site to start from according to the Alexa API
+    :param base_url: Address of the Alexa API, overridable to point at a stub server
+    :return: json
+    """
+    return f'{base_url}?Action=Topsites&Count={count}&ResponseGroup=Country&Start={start}&Output=json'
+
+
+class RetryableResponse(Exception):
+    pass
+
+
+class Collector:
+    """
+    Fetch Alexa Top Sites pages concurrently over a shared connection pool. The raw body of each page is appended
+    to the response archive, and a Response row records its Start offset and where it is archived, so the database
+    itself records which pages have been collected and a crashed run resumes with only the missing offsets.
+    """
+
+    def __init__(self, headers=None, base_url=ALEXA_API_URL, concurrency=QUERY_CONCURRENCY, retries=QUERY_RETRIES,
+                 backoff=QUERY_BACKOFF, archive=None):
+        self.archive = archive or ResponseArchive()
+        self.headers = headers or {}
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+
+    def pending(self, session, lower, limit, interval):
+        """
+        Find the Start offsets in range(lower, limit, interval) that have no stored Response yet
+
+        :return: list
+        """
+        collected = set()
+        for start, query in session.query(Response.start, Response.query):
+            if start is None:
+                # Responses collected before offsets were stored still carry them in their query URL
+                start = int(parse_qs(urlparse(query).query)['Start'][0])
+            collected.add(start)
+
+        return [start for start in range(lower, limit, interval) if start not in collected]
+
+    async def fetch(self, http, start, count):
+        url = query_api_url(count=count, start=start, base_url=self.base_url)
+        for attempt in range(self.retries + 1):
+            try:
+                async with http.get(url, headers=self.headers) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise RetryableResponse(f"HTTP {response.status}")
+                    response.raise_for_status()
+                    body = await response.read()
+                    # Bodies are archived unparsed, so only make sure a JSON document came back
+                    if not body.lstrip().startswith(b'{'):
+                        raise ValueError(f"Query at start {start} did not return JSON")
+                    return start, url, body
+            except aiohttp.ClientResponseError:
+                raise
+            except (RetryableResponse, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+                log.warning("Query at start %s failed (%s), retrying in %.1fs", start, e, delay)
+                await asyncio.sleep(delay)
+
+    async def collect(self, lower=1, limit=1001, interval=100):
+        """
+        Fetch every missing page between lower and limit, storing each one as soon as it arrives
+
+        :param lower: First Start offset
+        :param limit: Offset to stop before
+        :param interval: Number of sites per page
+        :return: int, number of pages that could not be fetched
+        """
+        session = Session()
+        failures = 0
+        try:
+            starts = self.pending(session, lower, limit, interval)
+            log.info("Querying %s pages of %s sites", len(starts), interval)
+
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            async with aiohttp.ClientSession(connector=connector) as http:
+                tasks = [self.fetch(http, start, interval) for start in starts]
+                for task in asyncio.as_completed(tasks):
+                    try:
+                        start, url, body = await task
+                    except Exception as e:
+                        log.error("Giving up on query: %s", e)
+                        failures += 1
+                        continue
+
+                    log.info("Storing sites at count %s", start)
+                    offset, length = self.archive.append(body)
+                    session.add(Response(query=url, start=start, archive_offset=offset, archive_length=length))
+                    session.commit()
+        finally:
+            session.close()
+
+        return failures
+
+    def run(self, lower=1, limit=1001, interval=100):
+        return asyncio.run(self.collect(lower, limit, interval))
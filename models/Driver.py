@@ -1,30 +1,36 @@
-import datetime
+import logging
 import os
 import platform
 import time
 
+import cv2
+import numpy as np
 from selenium import webdriver
 
+import services.FingerprintCache as FingerprintCache
+import services.Log as Log
 import services.Time as Time
 from config.app import SCREENSHOT_RGB_PATH
-from config.app import STORAGE_LOGS_PATH
 from config.driver import *
+from models.PostProcessor import PostProcessor, store_fingerprints
+from models.DriverScripts import CAPTURE_SCRIPT, HIDE_FIXED_SCRIPT, MEASURE_PAGE_SCRIPT, SCROLL_TO_SCRIPT, \
+    SETTLE_SCRIPT
+from services.Png import PngWriter, parse_header
 from migrations.Screenshot import Screenshot, ScreenshotEnum
 from migrations.Site import Site
 
+log = Log.get(__name__)
+
 
 class Driver:
-    def __init__(self, log_filename):
-        self.file = open(f"{STORAGE_LOGS_PATH}/{log_filename}", "x")
-        self.file.write(str(datetime.datetime.now()) + "\n\n")
+    def __init__(self):
         self.driver = webdriver.Firefox(**self.__boot())
+        self.round_trips = 0
+        self.__count_round_trips()
         self.driver.implicitly_wait(60)
-        self.model_path = None
-        self.model_type = ScreenshotEnum.RGB
-        self.model_scroll_height = 0
-        self.model_time_elapsed = "0"
-        self.model_exceeded_height = False
-        self.model_failed = False
+        self.pages = 0
+        self.post_processor = PostProcessor() if CAPTURE_POST_PROCESS else None
+        self.reset()
 
     def __boot(self):
         geckodriver = os.path.join('./drivers/',
@@ -42,6 +48,32 @@ class Driver:
         return {'executable_path': geckodriver, 'options': options, 'firefox_profile': profile,
                 'log_path': log}
 
+    def __count_round_trips(self):
+        # Every WebDriver command, including element commands, goes through WebDriver.execute
+        execute = self.driver.execute
+
+        def counted(*args, **kwargs):
+            self.round_trips += 1
+            return execute(*args, **kwargs)
+
+        self.driver.execute = counted
+
+    def reset(self):
+        self.round_trips = 0
+        self.window_size = None
+        self.model_path = None
+        self.model_type = ScreenshotEnum.RGB
+        self.model_scroll_height = 0
+        self.model_time_elapsed = "0"
+        self.model_exceeded_height = False
+        self.model_failed = False
+        self.model_round_trips = 0
+        self.model_tiled = False
+        self.model_width = None
+        self.model_height = None
+        self.error = None
+        self.outputs = []
+
     def get_scroll_height(self):
         return self.driver.execute_script("return document.body.scrollHeight")
 
@@ -54,15 +86,34 @@ class Driver:
     def scroll_to(self, height):
         return self.driver.execute_script(f"window.scrollTo(0, {height})")
 
+    def settle(self, ceiling, quiet):
+        """
+        Wait for the page to settle after a scroll. With ADAPTIVE_SETTLE the wait ends as soon as no new resources
+        have loaded, the scroll height is unchanged and visible images are complete for quiet seconds; ceiling is
+        the longest the wait may take either way. setup() sets the script timeout that covers every ceiling.
+
+        :param ceiling: Maximum number of seconds to wait
+        :param quiet: Number of seconds the page must stay idle to be considered settled
+        :return: None
+        """
+        if not ADAPTIVE_SETTLE:
+            time.sleep(ceiling)
+            return
+
+        try:
+            self.driver.execute_async_script(SETTLE_SCRIPT, ceiling * 1000, quiet * 1000)
+        except Exception as e:
+            log.warning("Adaptive settle failed, sleeping instead: %s", e)
+            time.sleep(ceiling)
+
     def quit(self):
         return self.driver.quit()
 
     def scroll(self, height):
         while True:
-            print(f"Scrolling to height {height}")
-            self.file.write(f"Scrolling to height {height} \n")
+            log.debug("Scrolling to height %s", height)
             self.scroll_to("document.body.scrollHeight")
-            time.sleep(SCROLL_PAUSE_TIME)
+            self.settle(SCROLL_PAUSE_TIME, SCROLL_QUIET_TIME)
 
             new_height = self.get_scroll_height()
             self.model_scroll_height = new_height
@@ -78,67 +129,192 @@ class Driver:
         current_scroll = 0
 
         while current_scroll < height:
-            print(f"Rescrolling page to {current_scroll}")
-            self.file.write(f"Rescrolling page to {current_scroll} \n")
+            log.debug("Rescrolling page to %s", current_scroll)
             self.scroll_to(current_scroll)
-            time.sleep(RESCROLL_PAUSE_TIME)
+            self.settle(RESCROLL_PAUSE_TIME, RESCROLL_QUIET_TIME)
             current_scroll += RESCROLL_INCREMENTS
 
+    def capture(self):
+        """
+        Run the scroll and rescroll sequence as a single async script, keeping the same behaviour as scroll() and
+        rescroll() but costing one WebDriver round trip instead of several per step
+
+        :return: int, the height to take the screenshot at
+        """
+        # Without adaptive settling the quiet period equals the pause, so every step waits for the full pause
+        scroll_quiet = SCROLL_QUIET_TIME if ADAPTIVE_SETTLE else SCROLL_PAUSE_TIME
+        rescroll_quiet = RESCROLL_QUIET_TIME if ADAPTIVE_SETTLE else RESCROLL_PAUSE_TIME
+
+        self.driver.set_script_timeout(CAPTURE_SCRIPT_TIMEOUT)
+        metrics = self.driver.execute_async_script(CAPTURE_SCRIPT, SCROLL_PAUSE_TIME * 1000, scroll_quiet * 1000,
+                                                   RESCROLL_PAUSE_TIME * 1000, rescroll_quiet * 1000,
+                                                   RESCROLL_INCREMENTS, MAX_SCROLL_HEIGHT)
+
+        self.model_scroll_height = metrics['scroll_height']
+        self.model_exceeded_height = metrics['exceeded_height']
+        self.window_size = metrics['window']
+        log.info("Captured page in %s scroll steps, scroll height %s in %ss", metrics['steps'],
+                 metrics['scroll_height'], metrics['elapsed'] / 1000)
+
+        return metrics['height']
+
     def screenshot(self, filename, start_time, height):
-        print(self.get_window_height())
-        self.file.write(f"Window height: {self.get_window_height()} \n")
+        window_size = self.window_size or self.get_window_height()
+        log.debug("Window height: %s", window_size)
         self.set_window_height(height + 150)
         self.driver.set_window_position(0, 0)
 
-        print(self.get_window_height())
-        self.file.write(f"Window height with 150px addition: {self.get_window_height()} \n")
+        if self.window_size is None and log.isEnabledFor(logging.DEBUG):
+            log.debug("Window height with 150px addition: %s", self.get_window_height())
 
         self.scroll_to("document.body.scrollHeight")
         path = f"{SCREENSHOT_RGB_PATH}/{filename}.png"
         self.model_path = path
         try:
-            self.driver.find_element_by_tag_name("body").screenshot(path)
+            data = self.driver.find_element_by_tag_name("body").screenshot_as_png
+            with open(path, 'wb') as f:
+                f.write(data)
+            header = parse_header(data)
+            self.model_width, self.model_height = header.width, header.height
+            if self.post_processor is not None:
+                self.post_process(data, filename)
         except Exception as e:
             self.model_failed = True
-            print("Something went wrong when trying to take the screenshot: ", e)
-            self.file.write(f"Something went wrong when trying to take the screenshot: {e} \n")
+            self.error = f"Screenshot failed: {e}"
+            log.error("Something went wrong when trying to take the screenshot: %s", e)
         finally:
-            self.model_time_elapsed = str(Time.time_elapsed(start_time, Time.now()))
-            print(f"Finished site {filename} in {Time.time_elapsed(start_time, Time.now())}")
-            self.file.write(f"Finished site {filename} in {Time.time_elapsed(start_time, Time.now())} \n\n")
+            self.__finish(filename, start_time)
 
-    def setup(self, name, url):
-        print(f"Beginning site {name} at url {url}")
-        self.file.write(f"Beginning site {name} at url {url} \n")
+    def post_process(self, data, filename):
+        # The capture itself succeeded, so a failure here only costs the derived copies
+        try:
+            self.outputs = self.post_processor.process(data, filename)
+        except Exception as e:
+            log.error("Something went wrong when post-processing the screenshot: %s", e)
+
+    def fingerprint_outputs(self):
+        # The capture is already committed, so a failure here only costs the cached fingerprints
+        try:
+            store_fingerprints(self.outputs)
+        except Exception as e:
+            log.error("Something went wrong when storing fingerprints of the screenshot: %s", e)
+
+    def screenshot_tiled(self, filename, start_time):
+        """
+        Take a full page screenshot as a series of viewport-sized tiles, streaming each tile's rows into the PNG
+        as it is captured. Peak memory is a single tile regardless of how tall the page is.
+
+        :param filename: Name of the screenshot file, without extension
+        :param start_time: Time the capture of the site started
+        :return: None
+        """
+        path = f"{SCREENSHOT_RGB_PATH}/{filename}.png"
+        self.model_path = path
+        self.model_tiled = True
+        writer = None
+        try:
+            height, width = self.driver.execute_script(MEASURE_PAGE_SCRIPT)
+            log.info("Capturing %spx page in tiles", height)
+
+            written = 0
+            while written < height:
+                offset = self.driver.execute_script(SCROLL_TO_SCRIPT, written)
+                tile = cv2.imdecode(np.frombuffer(self.driver.get_screenshot_as_png(), np.uint8), cv2.IMREAD_COLOR)
+                if writer is None:
+                    width = min(width, tile.shape[1])
+                    writer = PngWriter(path, width, height, level=TILED_CAPTURE_COMPRESSION)
+                    self.driver.execute_script(HIDE_FIXED_SCRIPT)
+
+                rows = tile[written - offset:min(tile.shape[0], height - offset), :width, ::-1]
+                if len(rows) == 0:
+                    # The page stopped scrolling short of its reported height, pad the rest with white
+                    log.warning("Page stopped scrolling at %spx, padding to %spx", written, height)
+                    rows = np.full((height - written, width, 3), 255, dtype=np.uint8)
+                writer.write_rows(rows)
+                written += len(rows)
+
+            writer.close()
+            self.model_width, self.model_height = width, height
+        except Exception as e:
+            self.model_failed = True
+            self.error = f"Tiled screenshot failed: {e}"
+            if writer is not None and not writer.file.closed:
+                writer.file.close()
+            log.error("Something went wrong when trying to take the tiled screenshot: %s", e)
+        finally:
+            self.__finish(filename, start_time)
+
+    def __finish(self, filename, start_time):
+        self.model_time_elapsed = str(Time.time_elapsed(start_time, Time.now()))
+        self.model_round_trips = self.round_trips
+        log.info("Finished site %s in %s using %s WebDriver round trips", filename, self.model_time_elapsed,
+                 self.round_trips)
+
+    def load(self, name, url):
+        log.info("Beginning site %s at url %s", name, url)
         self.set_window_height()
         self.driver.get(url)
 
-        return Time.now(), self.get_scroll_height()
+        return Time.now()
+
+    def setup(self, name, url):
+        if ADAPTIVE_SETTLE:
+            # Set once per site rather than before every settle, as each setting is a round trip
+            self.driver.set_script_timeout(max(SCROLL_PAUSE_TIME, RESCROLL_PAUSE_TIME) + 5)
+        return self.load(name, url), self.get_scroll_height()
 
     def run(self, site, session):
+        """
+        Capture a single site and record the resulting Screenshot. The browser session is left open so that the
+        same driver can be reused for further sites; call quit() once finished with it.
+
+        :param site: Site to capture
+        :param session: Session used to record the screenshot
+        :return: bool, whether the capture succeeded
+        """
         name = site.name
         url = f"http://{site.host}"
+        self.reset()
+        self.pages += 1
         try:
-            start_time, last_height = self.setup(name, url)
-            last_height = self.scroll(last_height)
-            self.rescroll(last_height)
-            self.screenshot(name, start_time, last_height)
+            if SINGLE_ROUND_TRIP_CAPTURE:
+                start_time = self.load(name, url)
+                last_height = self.capture()
+            else:
+                start_time, last_height = self.setup(name, url)
+                last_height = self.scroll(last_height)
+                self.rescroll(last_height)
+
+            if TILED_CAPTURE and last_height >= TILED_CAPTURE_MIN_HEIGHT:
+                self.screenshot_tiled(name, start_time)
+            else:
+                self.screenshot(name, start_time, last_height)
 
             model = Screenshot(site_id=site.id, path=self.model_path, type=ScreenshotEnum.RGB,
                                time_elapsed=self.model_time_elapsed,
                                scroll_height=self.model_scroll_height, exceeded_height=self.model_exceeded_height,
-                               failed=self.model_failed)
+                               failed=self.model_failed, round_trips=self.model_round_trips,
+                               tiled=self.model_tiled, width=self.model_width, height=self.model_height)
+            FingerprintCache.invalidate(self.model_path, session)
             site = session.query(Site).get(site.id)
             site.processed = True
             session.add(model)
+            for output in self.outputs:
+                FingerprintCache.invalidate(output['path'], session)
+                session.add(Screenshot(site_id=site.id, path=output['path'], type=output['type'],
+                                       width=output['fields']['width'], height=output['fields']['height']))
             session.commit()
+            self.fingerprint_outputs()
         except Exception as e:
+            session.rollback()
             model = Screenshot(site_id=site.id,
                                failed=True)
             site = session.query(Site).get(site.id)
             site.processed = True
             session.add(model)
             session.commit()
-            self.file.write(str(e))
-        finally:
-            self.file.close()
+            log.error("Capture of site %s failed: %s", name, e)
+            self.model_failed = True
+            self.error = str(e)
+
+        return not self.model_failed
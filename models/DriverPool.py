@@ -0,0 +1,71 @@
+import threading
+
+from config.driver import WORKER_COUNT, WORKER_MAX_PAGES
+from migrations.Site import Site
+from models.Base import Session
+from models.Driver import Driver
+from models.JobQueue import JobQueue
+import services.Log as Log
+
+log = Log.get(__name__)
+
+
+class DriverPool:
+    """
+    Pool of long-lived Driver instances that claim capture jobs from the jobs table. Each worker keeps its browser
+    open across sites and only recycles it after max_pages captures or when a capture fails. Pools in several
+    processes or on several machines sharing the database can drain the same queue.
+    """
+
+    def __init__(self, workers=WORKER_COUNT, max_pages=WORKER_MAX_PAGES):
+        self.workers = workers
+        self.max_pages = max_pages
+
+    def run(self):
+        """
+        Capture sites until no capture job is left to claim, blocking until every worker has finished
+
+        :return: None
+        """
+        threads = [threading.Thread(target=self.__work, args=(i,), name=f"driver-{i}") for i in
+                   range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def __boot(self, worker):
+        log.info("Booting browser for worker %s", worker)
+        return Driver()
+
+    def __work(self, worker):
+        session = Session()
+        jobs = JobQueue(session)
+        driver = None
+        try:
+            while True:
+                job = jobs.claim()
+                if job is None:
+                    break
+
+                try:
+                    if driver is None:
+                        driver = self.__boot(worker)
+                except Exception as e:
+                    jobs.fail(job, e)
+                    raise
+
+                site = session.query(Site).get(job.site_id)
+                if driver.run(site, session):
+                    jobs.complete(job)
+                else:
+                    jobs.fail(job, driver.error)
+
+                if driver.model_failed or driver.pages >= self.max_pages:
+                    log.info("Recycling browser for worker %s after %s pages", worker, driver.pages)
+                    driver.quit()
+                    driver = None
+        finally:
+            if driver is not None:
+                driver.quit()
+            session.close()
@@ -0,0 +1,115 @@
+# Scripts injected into the page by models.Driver. Async scripts receive their callback as the last argument.
+
+# Resolves once the page has loaded no new resources, kept the same scrollHeight and finished its visible images
+# for `quiet` milliseconds, or once `ceiling` milliseconds have passed.
+SETTLE_FUNCTION = """
+performance.setResourceTimingBufferSize(100000);
+
+const settle = (ceiling, quiet) => new Promise(resolve => {
+    const start = performance.now();
+    const pendingImages = () => Array.from(document.images).filter(image => {
+        const rect = image.getBoundingClientRect();
+        return !image.complete && rect.bottom >= 0 && rect.top <= window.innerHeight;
+    }).length;
+
+    let lastHeight = document.body.scrollHeight;
+    let lastResources = performance.getEntriesByType('resource').length;
+    let stableSince = start;
+
+    const check = () => {
+        const now = performance.now();
+        const height = document.body.scrollHeight;
+        const resources = performance.getEntriesByType('resource').length;
+
+        if (height !== lastHeight || resources !== lastResources || pendingImages() > 0
+            || document.readyState !== 'complete') {
+            lastHeight = height;
+            lastResources = resources;
+            stableSince = now;
+        }
+
+        if (now - stableSince >= quiet) {
+            resolve({settled: true, height: height, elapsed: now - start});
+        } else if (now - start >= ceiling) {
+            resolve({settled: false, height: height, elapsed: now - start});
+        } else {
+            setTimeout(check, 50);
+        }
+    };
+
+    check();
+});
+"""
+
+SETTLE_SCRIPT = SETTLE_FUNCTION + """
+settle(arguments[0], arguments[1]).then(arguments[arguments.length - 1]);
+"""
+
+# Runs the whole of Driver.scroll and Driver.rescroll inside the page and returns the measurements that the
+# individual WebDriver calls would otherwise have fetched one by one.
+CAPTURE_SCRIPT = SETTLE_FUNCTION + """
+const [scrollPause, scrollQuiet, rescrollPause, rescrollQuiet, increments, maxHeight] = arguments;
+const done = arguments[arguments.length - 1];
+
+(async () => {
+    const start = performance.now();
+    let height = document.body.scrollHeight;
+    let scrollHeight = height;
+    let exceeded = false;
+    let steps = 0;
+
+    while (true) {
+        window.scrollTo(0, document.body.scrollHeight);
+        steps++;
+        await settle(scrollPause, scrollQuiet);
+
+        scrollHeight = document.body.scrollHeight;
+        if (scrollHeight === height) {
+            break;
+        } else if (scrollHeight >= maxHeight) {
+            exceeded = true;
+            break;
+        }
+        height = scrollHeight;
+    }
+
+    for (let current = 0; current < height; current += increments) {
+        window.scrollTo(0, current);
+        steps++;
+        await settle(rescrollPause, rescrollQuiet);
+    }
+
+    window.scrollTo(0, document.body.scrollHeight);
+
+    done({
+        height: height,
+        scroll_height: scrollHeight,
+        exceeded_height: exceeded,
+        steps: steps,
+        window: {width: window.outerWidth, height: window.outerHeight},
+        elapsed: performance.now() - start
+    });
+})();
+"""
+
+# Scrolls as far down as the page allows and reports the reachable page height and the viewport width
+MEASURE_PAGE_SCRIPT = """
+window.scrollTo(0, Math.max(document.body.scrollHeight, document.documentElement.scrollHeight));
+return [window.pageYOffset + window.innerHeight, window.innerWidth];
+"""
+
+# Scrolls to the given offset and reports where the page actually ended up
+SCROLL_TO_SCRIPT = """
+window.scrollTo(0, arguments[0]);
+return window.pageYOffset;
+"""
+
+# Hides fixed and sticky elements so headers and banners are not repeated in every tile
+HIDE_FIXED_SCRIPT = """
+for (const element of document.querySelectorAll('body *')) {
+    const position = window.getComputedStyle(element).position;
+    if (position === 'fixed' || position === 'sticky') {
+        element.style.setProperty('visibility', 'hidden', 'important');
+    }
+}
+"""
@@ -0,0 +1,12 @@
+import enum
+
+
+class JobState(enum.Enum):
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+
+class JobKind(enum.Enum):
+    CAPTURE = "CAPTURE"
@@ -0,0 +1,133 @@
+"""
+Queue of jobs kept in the jobs table, so that any number of worker processes, on one machine or several sharing the
+database, can pull work from it. Jobs are claimed with a conditional UPDATE that only succeeds if the row is still
+in the state the worker read it in, so two workers can never claim the same job and no database locks are held
+between reading and claiming. A claim is a lease: jobs whose worker crashed become claimable again once the lease
+expires, until they run out of attempts.
+"""
+
+import datetime
+import os
+import socket
+import threading
+
+from sqlalchemy import and_, or_
+
+from config.driver import JOB_LEASE_TIME, JOB_MAX_ATTEMPTS
+from migrations.Job import Job
+from models.Job import JobKind, JobState
+
+# Number of candidates read per claim attempt, so that losing a race for one job does not need another query
+CLAIM_CANDIDATES = 8
+
+
+def worker_name():
+    """
+    Name identifying the current thread across machines and processes
+
+    :return: str
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+class JobQueue:
+    def __init__(self, session, kind=JobKind.CAPTURE, lease=JOB_LEASE_TIME, max_attempts=JOB_MAX_ATTEMPTS):
+        self.session = session
+        self.kind = kind
+        self.lease = datetime.timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+
+    def enqueue(self, site_ids, priority=0):
+        """
+        Add a pending job for every site that does not already have a pending or running one
+
+        :param site_ids: ids of the sites to add jobs for
+        :param priority: Jobs with a higher priority are claimed first
+        :return: int, number of jobs added
+        """
+        active = {site_id for site_id, in self.session.query(Job.site_id).filter(
+            Job.kind == self.kind, Job.state.in_([JobState.PENDING, JobState.RUNNING]))}
+        now = datetime.datetime.utcnow()
+
+        jobs = [{'site_id': site_id, 'kind': self.kind, 'state': JobState.PENDING, 'priority': priority,
+                 'attempts': 0, 'max_attempts': self.max_attempts, 'created_at': now, 'updated_at': now}
+                for site_id in dict.fromkeys(site_ids) if site_id not in active]
+        self.session.bulk_insert_mappings(Job, jobs)
+        self.session.commit()
+        return len(jobs)
+
+    def claimable(self, now):
+        return and_(Job.kind == self.kind, Job.attempts < Job.max_attempts,
+                    or_(Job.state == JobState.PENDING,
+                        and_(Job.state == JobState.RUNNING, Job.lease_expires < now)))
+
+    def claim(self, worker=None):
+        """
+        Lease the highest priority claimable job to worker
+
+        :param worker: Name of the claiming worker, by default worker_name()
+        :return: Job, detached from the session, or None once nothing is left to claim
+        """
+        worker = worker or worker_name()
+        while True:
+            now = datetime.datetime.utcnow()
+            candidates = self.session.query(Job.id, Job.state, Job.attempts).filter(self.claimable(now)) \
+                .order_by(Job.priority.desc(), Job.id).limit(CLAIM_CANDIDATES).all()
+            self.session.commit()
+            if not candidates:
+                return None
+
+            for job_id, state, attempts in candidates:
+                # attempts increases with every claim, so it doubles as the row's version
+                claimed = self.session.query(Job).filter(
+                    Job.id == job_id, Job.state == state, Job.attempts == attempts, self.claimable(now)
+                ).update({'state': JobState.RUNNING, 'attempts': attempts + 1, 'worker': worker,
+                          'lease_expires': now + self.lease, 'updated_at': now}, synchronize_session=False)
+                self.session.commit()
+                if claimed:
+                    # Detached, so that the claim is remembered as made even if another worker takes the job over
+                    job = self.session.query(Job).get(job_id)
+                    self.session.expunge(job)
+                    return job
+
+    def complete(self, job):
+        """
+        Mark a job claimed by this worker as done
+
+        :return: bool, False if the lease was lost to another worker
+        """
+        return self.__finish(job, {'state': JobState.DONE, 'error': None})
+
+    def fail(self, job, error):
+        """
+        Return a job claimed by this worker to the queue, or mark it failed once it has used all of its attempts
+
+        :param job: Claimed job
+        :param error: Description of the failure
+        :return: bool, False if the lease was lost to another worker
+        """
+        state = JobState.FAILED if job.attempts >= job.max_attempts else JobState.PENDING
+        return self.__finish(job, {'state': state, 'error': str(error)})
+
+    def reap(self):
+        """
+        Mark running jobs whose lease expired after their last attempt as failed, since nothing can claim them
+
+        :return: int, number of jobs marked failed
+        """
+        now = datetime.datetime.utcnow()
+        reaped = self.session.query(Job).filter(
+            Job.kind == self.kind, Job.state == JobState.RUNNING, Job.lease_expires < now,
+            Job.attempts >= Job.max_attempts
+        ).update({'state': JobState.FAILED, 'error': 'Lease expired', 'updated_at': now},
+                 synchronize_session=False)
+        self.session.commit()
+        return reaped
+
+    def __finish(self, job, values):
+        finished = self.session.query(Job).filter(
+            Job.id == job.id, Job.state == JobState.RUNNING, Job.worker == job.worker, Job.attempts == job.attempts
+        ).update({**values, 'lease_expires': None, 'updated_at': datetime.datetime.utcnow()},
+                 synchronize_session=False)
+        self.session.commit()
+        return finished == 1
@@ -0,0 +1,66 @@
+"""
+Capture-time post-processing. The screenshot bytes returned by the browser are decoded once and turned into every
+derived image the study pipeline needs, so the RGB file is never read back from disk: the greyscale copy, the
+greyscale copy cropped to CROP_WIDTH x CROP_HEIGHT, and the 224x224 thumbnail and hashes of both, which go
+straight into the fingerprint cache.
+"""
+
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+import services.FingerprintCache as FingerprintCache
+from config.app import SCREENSHOT_GREY_PATH, SCREENSHOT_CROP_PATH, CROP_WIDTH, CROP_HEIGHT, GREYSCALE_COMPRESSION
+from models.Screenshot import ScreenshotEnum
+
+
+class PostProcessor:
+    def __init__(self, compression=GREYSCALE_COMPRESSION, width=CROP_WIDTH, height=CROP_HEIGHT):
+        self.compression = compression
+        self.width = width
+        self.height = height
+        os.makedirs(SCREENSHOT_CROP_PATH, exist_ok=True)
+
+    def process(self, data, name):
+        """
+        Write the derived images of one screenshot
+
+        :param data: PNG bytes of the RGB screenshot
+        :param name: Site name, used as the file name of every output
+        :return: list of dicts with the type, path, content_hash and fingerprint fields of each output
+        """
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not decode screenshot of {name}")
+        grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        del image
+
+        return [
+            self.__write(grey, ScreenshotEnum.GREYSCALE, f"{SCREENSHOT_GREY_PATH}/{name}.png"),
+            self.__write(grey[:self.height, :self.width], ScreenshotEnum.CROPPED, f"{SCREENSHOT_CROP_PATH}/{name}.png")
+        ]
+
+    def __write(self, image, type, path):
+        ok, encoded = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, self.compression])
+        if not ok:
+            raise ValueError(f"Could not encode {path}")
+        data = encoded.tobytes()
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        return {'type': type, 'path': path, 'content_hash': hashlib.sha1(data).hexdigest(),
+                'fields': FingerprintCache.compute(image)}
+
+
+def store_fingerprints(outputs):
+    """
+    Record the fingerprints computed by PostProcessor.process, once the Screenshot rows for the outputs exist
+
+    :param outputs: Return value of PostProcessor.process
+    :return: None
+    """
+    for output in outputs:
+        FingerprintCache.store(output['path'], os.stat(output['path']).st_mtime, output['content_hash'],
+                               output['fields'])
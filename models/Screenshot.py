@@ -1,18 +1,75 @@
 import enum
+import os
 
 import cv2
 
-from config.app import SCREENSHOT_RGB_PATH, SCREENSHOT_GREY_PATH
+import services.Png as Png
+from config.app import SCREENSHOT_RGB_PATH, SCREENSHOT_GREY_PATH, GREYSCALE_COMPRESSION
 
 
-def to_greyscale(filepath, name):
+def to_greyscale(filepath, name, compression=GREYSCALE_COMPRESSION):
+    """
+    Write a greyscale copy of the image at filepath. Kept at module level so that it can run in a process pool.
+
+    :param filepath: Path of the RGB screenshot
+    :param name: Site name, used as the file name of the copy
+    :param compression: PNG compression level, 0-9
+    :return: Path of the greyscale copy
+    """
     image = cv2.imread(filepath)
+    if image is None:
+        raise FileNotFoundError(f"Could not read image {filepath}")
     grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     path = f'{SCREENSHOT_GREY_PATH}/{name}.png'
-    cv2.imwrite(path, grey)
+    cv2.imwrite(path, grey, [cv2.IMWRITE_PNG_COMPRESSION, compression])
     return path
 
 
+def crop(path, width, height, compression=GREYSCALE_COMPRESSION):
+    """
+    Crop the image at path to at most width x height from its top-left corner, replacing the file atomically. PNGs
+    are cropped from their filtered scanlines without decoding; anything else is decoded and re-encoded.
+
+    :param path: Path of the image
+    :param width: Maximum width
+    :param height: Maximum height
+    :param compression: PNG compression level, 0-9
+    :return: tuple of the new height and width
+    """
+    try:
+        header = Png.crop(path, width, height, compression)
+        return header.height, header.width
+    except Png.UnsupportedPng:
+        pass
+
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(f"Could not read image {path}")
+    image = image[:height, :width]
+    write_png(path, image, compression)
+    return image.shape[0], image.shape[1]
+
+
+def write_png(path, image, compression=GREYSCALE_COMPRESSION):
+    """
+    Encode image as a PNG into a temporary file that then replaces path, so that path never holds a partial image
+
+    :param path: Path to write
+    :param image: Image as a numpy.ndarray
+    :param compression: PNG compression level, 0-9
+    :return: None
+    """
+    ok, encoded = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    if not ok:
+        raise ValueError(f"Could not encode {path}")
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(encoded.tobytes())
+    os.replace(f"{path}.tmp", path)
+
+
 class ScreenshotEnum(enum.Enum):
     RGB = "RGB"
     GREYSCALE = "GREYSCALE"
+    CROPPED = "CROPPED"
+    # Copies in CLUSTER_DATA_PATH, which set_image_dimensions crops in place
+    CLUSTER_DATA = "CLUSTER_DATA"
@@ -0,0 +1,179 @@
+"""
+Approximate nearest-neighbour search over per-screenshot feature vectors, as an inverted file (IVF) index built on
+NumPy. Vectors are normalised and compared by cosine distance. They are partitioned around k-means centroids, and
+a query only scans the n_probe partitions closest to it, so the cost of a query grows with n / n_lists rather than n.
+"""
+
+import os
+
+import numpy as np
+
+import services.Domains as Domains
+from config.app import ANN_INDEX_PATH, CLUSTER_DATA_PATH
+from migrations.Fingerprint import Fingerprint
+from migrations.FingerprintPath import FingerprintPath
+# Fingerprint's relationship needs Screenshot mapped
+from migrations.Screenshot import Screenshot  # noqa: F401
+from migrations.Site import Site
+from models.Base import Session
+from services.EmbeddingStore import backbone_store
+
+
+def normalise(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class AnnIndex:
+    def __init__(self, keys, vectors, centroids, assignments):
+        self.keys = np.asarray(keys)
+        self.rows = {key: row for row, key in enumerate(self.keys.tolist())}
+        self.vectors = vectors
+        self.centroids = centroids
+
+        # Rows grouped by partition: partition i holds order[offsets[i]:offsets[i + 1]]
+        self.assignments = assignments
+        self.order = np.argsort(assignments, kind='stable')
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(len(centroids) + 1))
+
+    @classmethod
+    def build(cls, keys, vectors, n_lists=None, iterations=10, seed=728):
+        """
+        Build an index over vectors
+
+        :param keys: Key of each vector, returned by queries
+        :param vectors: 2D array of vectors
+        :param n_lists: Number of partitions, by default the square root of the number of vectors
+        :param iterations: Number of k-means iterations used to place the centroids
+        :return: AnnIndex
+        """
+        vectors = normalise(vectors)
+        n_lists = min(len(vectors), n_lists or max(1, int(np.sqrt(len(vectors)))))
+
+        random = np.random.RandomState(seed)
+        sample = vectors[random.choice(len(vectors), min(len(vectors), n_lists * 256), replace=False)]
+        centroids = sample[random.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = sample[nearest == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = normalise(centroids)
+
+        assignments = np.concatenate([np.argmax(vectors[start:start + 4096] @ centroids.T, axis=1)
+                                      for start in range(0, len(vectors), 4096)])
+        return cls(keys, vectors, centroids, assignments)
+
+    def query(self, vector, k=10, n_probe=8):
+        """
+        Approximate k nearest neighbours of vector
+
+        :param vector: Query vector
+        :param k: Number of neighbours to return
+        :param n_probe: Number of partitions to scan, trading speed for recall
+        :return: list of (key, cosine distance), nearest first
+        """
+        vector = normalise(np.asarray(vector).reshape(1, -1))[0]
+        partitions = np.argsort(-(self.centroids @ vector))[:n_probe]
+        candidates = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in partitions])
+
+        distances = 1 - self.vectors[candidates] @ vector
+        nearest = np.argsort(distances)[:k]
+        return [(self.keys[candidates[i]].item(), float(distances[i])) for i in nearest]
+
+    def neighbours(self, key, k=10, n_probe=8):
+        """
+        Approximate k nearest neighbours of an indexed key, excluding the key itself
+
+        :return: list of (key, cosine distance), nearest first
+        """
+        results = self.query(self.vectors[self.rows[key]], k + 1, n_probe)
+        return [(other, distance) for other, distance in results if other != key][:k]
+
+    def save(self, path=ANN_INDEX_PATH):
+        np.savez(path, keys=self.keys, vectors=self.vectors, centroids=self.centroids, assignments=self.assignments)
+
+    @classmethod
+    def load(cls, path=ANN_INDEX_PATH):
+        data = np.load(path)
+        return cls(data['keys'], data['vectors'], data['centroids'], data['assignments'])
+
+
+def site_vectors(source='fingerprint'):
+    """
+    One feature vector per site, taken from the fingerprint cache or from an embedding store. Every site is
+    represented by its copy in CLUSTER_DATA_PATH, the cropped greyscale image that clustering reads, so that all
+    vectors describe the same top part of a page. Sites without a fingerprinted copy there are left out.
+
+    :param source: 'fingerprint' for the cached DCT feature vectors, or the name of a keras backbone whose
+                   EmbeddingStore should be used
+    :return: (list of site ids, 2D array of vectors)
+    """
+    session = Session()
+    sites = {name: site_id for site_id, name in session.query(Site.id, Site.name)}
+
+    # Copies in the cluster folder are named after their site
+    cluster_data = os.path.abspath(CLUSTER_DATA_PATH)
+    hash_by_site = {}
+    for path, content_hash in session.query(FingerprintPath.path, FingerprintPath.content_hash):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if os.path.dirname(os.path.abspath(path)) == cluster_data and name in sites:
+            hash_by_site[sites[name]] = content_hash
+
+    if source == 'fingerprint':
+        features = dict(session.query(Fingerprint.content_hash, Fingerprint.feature))
+        site_ids = [site_id for site_id, content_hash in hash_by_site.items() if content_hash in features]
+        vectors = [np.frombuffer(features[hash_by_site[site_id]], np.float32) for site_id in site_ids]
+    else:
+        store = backbone_store(source)
+        site_ids = [site_id for site_id, content_hash in hash_by_site.items() if content_hash in store]
+        vectors = store.get([hash_by_site[site_id] for site_id in site_ids])
+    session.close()
+
+    return site_ids, np.asarray(vectors, dtype=np.float32)
+
+
+def build_site_index(source='fingerprint', n_lists=None, path=ANN_INDEX_PATH):
+    site_ids, vectors = site_vectors(source)
+    index = AnnIndex.build(site_ids, vectors, n_lists)
+    index.save(path)
+    return index
+
+
+def similar_sites(host, k=10, n_probe=8, path=ANN_INDEX_PATH):
+    """
+    Sites whose screenshots look most like the screenshot of host
+
+    :return: list of (Site, cosine distance), most similar first
+    """
+    index = AnnIndex.load(path)
+    session = Session()
+    site = session.query(Site).filter_by(host=host).one()
+    results = index.neighbours(site.id, k, n_probe)
+    sites = {s.id: s for s in session.query(Site).filter(Site.id.in_([site_id for site_id, _ in results]))}
+    session.close()
+    return [(sites[site_id], distance) for site_id, distance in results]
+
+
+def near_duplicate_sites(max_distance=0.02, n_probe=1, path=ANN_INDEX_PATH):
+    """
+    Pairs of sites on different registrable domains whose screenshots are within max_distance of each other
+
+    :return: list of (Site, Site, cosine distance)
+    """
+    index = AnnIndex.load(path)
+    session = Session()
+    sites = {site.id: site for site in session.query(Site)}
+    session.close()
+
+    pairs = []
+    for site_id in index.keys.tolist():
+        for other, distance in index.neighbours(site_id, 10, n_probe):
+            if distance > max_distance or other < site_id:
+                continue
+            if Domains.parse(sites[site_id].host).root_domain != Domains.parse(sites[other].host).root_domain:
+                pairs.append((sites[site_id], sites[other], distance))
+
+    return pairs
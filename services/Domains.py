@@ -0,0 +1,110 @@
+"""
+Host name parsing against the public suffix list. The list is loaded once into a trie of reversed labels, and
+every host is parsed once per process, so grouping thousands of hosts costs one dictionary walk each.
+"""
+
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import tld
+
+from config.app import PUBLIC_SUFFIX_LIST_PATH
+
+DomainParts = namedtuple('DomainParts', ['subdomain', 'domain', 'suffix', 'root_domain', 'key', 'geo_tld'])
+
+RULE = '$'
+EXCEPTION = '!'
+WILDCARD = '*'
+
+
+@lru_cache(maxsize=None)
+def suffix_trie(path=PUBLIC_SUFFIX_LIST_PATH):
+    """
+    Trie of public suffix rules keyed by reversed labels, so that co.uk is stored as uk -> co. Rule ends are marked
+    with RULE and exception rules (!www.ck) with EXCEPTION.
+
+    :param path: Path of a public suffix list, by default the copy bundled with the tld package
+    :return: dict
+    """
+    path = path or os.path.join(os.path.dirname(tld.__file__), 'res', 'effective_tld_names.dat.txt')
+    trie = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            rule = line.strip().split(' ')[0]
+            if not rule or rule.startswith('//'):
+                continue
+
+            marker = RULE
+            if rule.startswith('!'):
+                marker = EXCEPTION
+                rule = rule[1:]
+
+            node = trie
+            for label in reversed(rule.split('.')):
+                node = node.setdefault(label, {})
+            node[marker] = True
+
+    return trie
+
+
+def suffix_length(labels, trie):
+    """
+    Number of trailing labels that form the public suffix, following the public suffix list algorithm: the longest
+    matching rule wins, exception rules take precedence and a host matching no rule has a one label suffix
+
+    :param labels: Labels of the host, such as ['www', 'example', 'co', 'uk']
+    :return: int
+    """
+    length = 1
+    node = trie
+    for i, label in enumerate(reversed(labels)):
+        child = node.get(label)
+        if child is not None and EXCEPTION in child:
+            return i
+        if child is None:
+            child = node.get(WILDCARD)
+        if child is None:
+            break
+        if RULE in child:
+            length = i + 1
+        node = child
+
+    return length
+
+
+@lru_cache(maxsize=None)
+def parse(host):
+    """
+    Split a host into subdomain, registrable domain label and public suffix
+
+    parse('mail.google.co.uk') gives subdomain 'mail', domain 'google', suffix 'co.uk', root_domain
+    'google.co.uk' and key 'mail.google', the key shared by the same site on other TLDs.
+
+    :param host: Host name, without protocol
+    :return: DomainParts
+    """
+    labels = host.lower().rstrip('.').split('.')
+    length = min(suffix_length(labels, suffix_trie()), len(labels) - 1)
+
+    suffix = '.'.join(labels[len(labels) - length:]) if length else ''
+    domain = labels[len(labels) - length - 1]
+    subdomain = '.'.join(labels[:len(labels) - length - 1])
+    root_domain = '.'.join(label for label in (domain, suffix) if label)
+    key = '.'.join(label for label in (subdomain, domain) if label)
+
+    # Country code TLDs are the two letter top level labels, such as uk in co.uk
+    geo_tld = len(labels[-1]) == 2 and labels[-1].isalpha()
+
+    return DomainParts(subdomain, domain, suffix, root_domain, key, geo_tld)
+
+
+def columns(host):
+    """
+    Values of the precomputed domain columns on Site for host
+
+    :return: dict
+    """
+    parts = parse(host)
+    return {'subdomain': parts.subdomain, 'root_domain': parts.root_domain, 'suffix': parts.suffix,
+            'domain_key': parts.key, 'geo_tld': parts.geo_tld}
@@ -0,0 +1,94 @@
+import json
+import os
+
+import numpy as np
+
+from config.app import EMBEDDING_STORE_PATH
+
+
+class EmbeddingStore:
+    """
+    On-disk store of one embedding per image for a single backbone: a float16 matrix in a memory-mapped .npy file
+    plus a JSON index mapping each key to its row. New embeddings are added with append(), which rewrites the
+    matrix once per call and saves the index only after every row has been written, so an interrupted append
+    leaves the previous contents intact.
+    """
+
+    def __init__(self, name, path=EMBEDDING_STORE_PATH):
+        self.matrix_path = f"{path}/{name}.npy"
+        self.index_path = f"{path}/{name}.json"
+        os.makedirs(path, exist_ok=True)
+
+        self.keys = []
+        self.matrix = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.keys = json.load(f)
+            self.matrix = np.load(self.matrix_path, mmap_mode='r')
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, keys):
+        """
+        Embeddings for keys, in the order given
+
+        :return: float16 numpy.ndarray
+        """
+        return self.matrix[[self.rows[key] for key in keys]]
+
+    def append(self, keys, batches):
+        """
+        Add embeddings for keys not yet in the store
+
+        :param keys: Keys of the new embeddings
+        :param batches: Iterable of 2D arrays whose rows, concatenated, are the embeddings for keys in order
+        :return: None
+        """
+        if not keys:
+            return
+
+        temp_path = f"{self.matrix_path}.tmp.npy"
+        matrix = None
+        row = len(self.keys)
+        for batch in batches:
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float16,
+                                                   shape=(len(self.keys) + len(keys), batch.shape[1]))
+                for start in range(0, len(self.keys), 1024):
+                    end = min(start + 1024, len(self.keys))
+                    matrix[start:end] = self.matrix[start:end]
+            matrix[row:row + len(batch)] = batch
+            row += len(batch)
+
+        if row != len(self.keys) + len(keys):
+            raise ValueError(f"Expected {len(keys)} new embeddings, got {row - len(self.keys)}")
+
+        matrix.flush()
+        del matrix
+        os.replace(temp_path, self.matrix_path)
+
+        self.keys = self.keys + list(keys)
+        with open(f"{self.index_path}.tmp", 'w') as f:
+            json.dump(self.keys, f)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+        self.matrix = np.load(self.matrix_path, mmap_mode='r')
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+
+
+def backbone_store(backbone, path=EMBEDDING_STORE_PATH):
+    """
+    Store of the embeddings computed by a keras backbone. Images are fed to the backbone as 0-255 pixel values through
+    its preprocess_input, and the store name records that so embeddings computed from any other input range are never
+    mixed in.
+
+    :param backbone: Name of the backbone, as passed to Clustering's use_imagenets
+    :param path: Folder of the store files
+    :return: EmbeddingStore
+    """
+    return EmbeddingStore(f"{backbone.lower()}_preprocessed", path)
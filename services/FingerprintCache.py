@@ -0,0 +1,212 @@
+"""
+Persistent cache of per-image fingerprints, stored in the fingerprints table next to screenshots. An image is
+decoded once; afterwards its size, hashes, 224x224 greyscale thumbnail and low-frequency DCT feature vector are
+served from the database. Fingerprints are keyed by the SHA-1 of the file content, so that copies, such as those in
+CLUSTER_DATA_PATH, share the entry of the original screenshot. Every path the cache has seen is recorded with its
+mtime and content hash in fingerprint_paths, so a file is only read again once it has changed.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import services.Png as Png
+from migrations.Fingerprint import Fingerprint
+from migrations.FingerprintPath import FingerprintPath
+from migrations.Screenshot import Screenshot
+from models.Base import Session
+
+THUMBNAIL_SIZE = 224
+HASH_SIZE = 8
+
+# Fingerprints most recently looked up by this process, keyed by (path, mtime). Each holds a thumbnail of about 50KB,
+# so only the latest MEMO_SIZE are kept.
+MEMO_SIZE = 1024
+memo = OrderedDict()
+lock = threading.Lock()
+
+
+def pack_bits(bits):
+    return f"{int(''.join('1' if bit else '0' for bit in bits.flatten()), 2):016x}"
+
+
+def compute(image):
+    """
+    Compute every cached field from a decoded greyscale image
+
+    :param image: Greyscale image as a uint8 numpy.ndarray
+    :return: dict
+    """
+    thumbnail = cv2.resize(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+
+    dct = cv2.dct(np.float32(cv2.resize(thumbnail, (32, 32), interpolation=cv2.INTER_AREA)))[:HASH_SIZE, :HASH_SIZE]
+    # The DC term only reflects overall brightness and would dominate the feature vector
+    layout = dct.flatten()
+    layout[0] = 0
+    difference = cv2.resize(thumbnail, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+
+    return {
+        'width': image.shape[1],
+        'height': image.shape[0],
+        'phash': pack_bits(dct > np.median(dct)),
+        'dhash': pack_bits(difference[:, 1:] > difference[:, :-1]),
+        'thumbnail': thumbnail.tobytes(),
+        'feature': np.float32(layout / (np.linalg.norm(layout) or 1)).tobytes()
+    }
+
+
+def compute_data(data, path):
+    """
+    Compute every cached field from encoded image data. The thumbnail and hashes only need a fraction of a full page
+    screenshot's pixels, so the image is decoded at a quarter of its size and the full size is read from the PNG
+    header.
+
+    :param data: Bytes of the image file
+    :param path: Path of the image, for error messages
+    :return: dict
+    """
+    try:
+        header = Png.parse_header(data)
+        flags = cv2.IMREAD_REDUCED_GRAYSCALE_4
+    except ValueError:
+        # Other formats are decoded in full to learn their size
+        header = None
+        flags = cv2.IMREAD_GRAYSCALE
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if image is None:
+        raise ValueError(f"Could not decode image {path}")
+    fields = compute(image)
+    if header is not None:
+        fields.update(width=header.width, height=header.height)
+    return fields
+
+
+def get(path, remember=True):
+    """
+    Fingerprint of the image at path, computing and storing it if the cache has no entry for the file's content.
+    Safe to call from several threads; decoding runs in parallel while database access is serialised.
+
+    :param path: Path of the image
+    :param remember: Keep the fingerprint in this process' memo, pass False for bulk loads that read each image once
+    :return: Fingerprint, detached from any session
+    """
+    mtime = os.stat(path).st_mtime
+    with lock:
+        if (path, mtime) in memo:
+            memo.move_to_end((path, mtime))
+            return memo[(path, mtime)]
+
+    fingerprint = find_path(path, mtime)
+    if fingerprint is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+        content_hash = hashlib.sha1(data).hexdigest()
+
+        fields = None
+        if find(content_hash=content_hash) is None:
+            fields = compute_data(data, path)
+
+        fingerprint = store(path, mtime, content_hash, fields)
+
+    if remember:
+        with lock:
+            memo[(path, mtime)] = fingerprint
+            if len(memo) > MEMO_SIZE:
+                memo.popitem(last=False)
+    return fingerprint
+
+
+def find_path(path, mtime):
+    with lock:
+        session = Session(expire_on_commit=False)
+        try:
+            fingerprint = session.query(Fingerprint) \
+                .join(FingerprintPath, FingerprintPath.content_hash == Fingerprint.content_hash) \
+                .filter(FingerprintPath.path == path, FingerprintPath.mtime == mtime).first()
+            if fingerprint is not None:
+                session.expunge(fingerprint)
+            return fingerprint
+        finally:
+            session.close()
+
+
+def find(**criteria):
+    with lock:
+        session = Session(expire_on_commit=False)
+        try:
+            fingerprint = session.query(Fingerprint).filter_by(**criteria).first()
+            if fingerprint is not None:
+                session.expunge(fingerprint)
+            return fingerprint
+        finally:
+            session.close()
+
+
+def store(path, mtime, content_hash, fields):
+    """
+    Record that path holds content_hash as of mtime, creating the entry for content_hash from fields if there is none
+
+    :return: Fingerprint, detached from any session
+    """
+    with lock:
+        session = Session(expire_on_commit=False)
+        try:
+            fingerprint = session.query(Fingerprint).filter_by(content_hash=content_hash).first()
+            if fingerprint is None:
+                # Recaptures reuse the same path, link the latest screenshot
+                screenshot = session.query(Screenshot.id).filter_by(path=path).order_by(Screenshot.id.desc()).first()
+                screenshot_id = screenshot.id if screenshot else None
+                fingerprint = Fingerprint(screenshot_id=screenshot_id, content_hash=content_hash, **fields)
+                session.add(fingerprint)
+
+            known = session.query(FingerprintPath).filter_by(path=path).first()
+            if known is None:
+                known = FingerprintPath(path=path)
+                session.add(known)
+            known.mtime = mtime
+            known.content_hash = content_hash
+
+            session.commit()
+            session.expunge(fingerprint)
+            return fingerprint
+        finally:
+            session.close()
+
+
+def thumbnail(path, remember=True):
+    """
+    Cached 224x224 greyscale thumbnail of the image at path
+
+    :param remember: As for get
+    :return: numpy.ndarray
+    """
+    return np.frombuffer(get(path, remember).thumbnail, np.uint8).reshape(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+
+
+def feature(path):
+    """
+    Cached unit-length feature vector of the image at path
+
+    :return: numpy.ndarray
+    """
+    return np.frombuffer(get(path).feature, np.float32)
+
+
+def invalidate(path, session):
+    """
+    Forget the content recorded for path, for when the file is about to be replaced. The fingerprint of the old
+    content stays, since other paths may still hold it.
+
+    :param path: Path of the image
+    :param session: Session to delete the entries in, committed by the caller
+    :return: None
+    """
+    with lock:
+        for key in [key for key in memo if key[0] == path]:
+            del memo[key]
+    session.query(FingerprintPath).filter_by(path=path).delete(synchronize_session=False)
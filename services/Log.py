@@ -0,0 +1,171 @@
+"""
+Shared logging for the pipeline. Loggers hand records to a queue, and a listener thread formats and writes them,
+so logging costs the caller little more than a queue put. Every run writes one JSON-lines file in
+STORAGE_LOGS_PATH, rotated once it grows past LOG_MAX_BYTES, and prints plain messages to the console.
+
+Modules log through a logger from get():
+
+    log = Log.get(__name__)
+    log.info("Finished site %s in %s", name, elapsed)
+    log.debug("Domains with values: %s", domains)
+
+Arguments are only formatted when the record is emitted, so debug records with large values cost nothing unless
+LOG_LEVEL is DEBUG. Processes forked from a run log to their own file next to the run's. Entry points can name the
+run's file with setup('crawl').
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import sys
+
+from config.app import LOGGING, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, STORAGE_LOGS_PATH
+from services.Time import file_safe_timestamp
+
+ROOT = 'research'
+
+# Base path of this run's log files, the process that started the run, and the listener and file handler writing
+# this process' records
+run = None
+run_pid = None
+listener = None
+file_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        return json.dumps(entry, default=str)
+
+
+def path():
+    # Processes forked from the run must not write to the parent's file
+    if os.getpid() == run_pid:
+        return f"{run}.jsonl"
+    return f"{run}_{os.getpid()}.jsonl"
+
+
+def start(level=LOG_LEVEL):
+    """
+    Start logging for this process, unless it already has. Called by get().
+
+    :param level: Lowest level written to the log file
+    :return: None
+    """
+    global run, run_pid, listener, file_handler
+    if listener is not None:
+        return
+
+    if run is None:
+        run = f"{STORAGE_LOGS_PATH}/run_{file_safe_timestamp()}"
+        run_pid = os.getpid()
+
+    handlers = []
+    file_handler = None
+    if LOGGING:
+        os.makedirs(STORAGE_LOGS_PATH, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(path(), maxBytes=LOG_MAX_BYTES,
+                                                            backupCount=LOG_BACKUP_COUNT, encoding='utf-8',
+                                                            delay=True)
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
+    handlers.append(console_handler)
+
+    records = queue.Queue()
+    logger = logging.getLogger(ROOT)
+    logger.handlers.clear()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+
+def setup(name, level=LOG_LEVEL):
+    """
+    Name this run's log file and set the lowest level written to it. Modules start logging as soon as they are
+    imported, so the file already in use is renamed, keeping anything written to it so far.
+
+    :param name: Prefix of the run's log file, such as 'crawl' for crawl_<timestamp>.jsonl
+    :param level: Lowest level written to the log file
+    :return: None
+    """
+    global run
+    start()
+    logging.getLogger(ROOT).setLevel(level)
+
+    if file_handler is None:
+        run = f"{STORAGE_LOGS_PATH}/{name}_{file_safe_timestamp()}"
+        return
+
+    # Holding the handler's lock keeps the listener from writing while the file moves
+    file_handler.acquire()
+    try:
+        if file_handler.stream is not None:
+            file_handler.stream.close()
+            file_handler.stream = None
+        previous = file_handler.baseFilename
+        run = f"{STORAGE_LOGS_PATH}/{name}_{file_safe_timestamp()}"
+        file_handler.baseFilename = os.path.abspath(path())
+        if os.path.exists(previous):
+            os.replace(previous, file_handler.baseFilename)
+    finally:
+        file_handler.release()
+
+
+def shutdown():
+    """
+    Write out every queued record and stop the listener
+
+    :return: None
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+
+def get(name):
+    """
+    Logger for a module, starting logging for this process if needed
+
+    :param name: Module name, usually __name__
+    :return: logging.Logger
+    """
+    start()
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def forked():
+    # The listener thread does not survive a fork, so a forked process starts its own. Pool workers leave through
+    # os._exit, which skips atexit but still runs multiprocessing finalizers.
+    global listener
+    if listener is not None:
+        listener = None
+        start()
+        multiprocessing.util.Finalize(None, shutdown, exitpriority=10)
+
+
+atexit.register(shutdown)
+# Windows has no fork, so processes it spawns import this module afresh and start logging on their own
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forked)
@@ -0,0 +1,241 @@
+import os
+import struct
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG colour types by channel count (greyscale, greyscale with alpha, RGB, RGBA)
+COLOUR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+CHANNELS = {colour_type: channels for channels, colour_type in COLOUR_TYPES.items()}
+
+FILTER_UP = 2
+
+
+class UnsupportedPng(ValueError):
+    pass
+
+
+PngHeader = namedtuple('PngHeader', ['width', 'height', 'bit_depth', 'colour_type', 'interlace'])
+
+
+def chunk(chunk_type, data):
+    """
+    Build a PNG chunk: length, type, data and the CRC over type + data
+
+    :param chunk_type: Four byte chunk type, such as b'IDAT'
+    :param data: Chunk payload
+    :return: bytes
+    """
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def parse_header(data):
+    """
+    Parse the IHDR chunk at the start of PNG data, such as the bytes of a screenshot held in memory
+
+    :param data: At least the first 33 bytes of a PNG
+    :return: PngHeader
+    """
+    if len(data) < 33 or data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        raise ValueError("Data is not a PNG")
+
+    width, height, bit_depth, colour_type, _, _, interlace = struct.unpack('>IIBBBBB', data[16:29])
+    return PngHeader(width, height, bit_depth, colour_type, interlace)
+
+
+def read_header(path):
+    """
+    Read the IHDR chunk of a PNG without decoding any pixel data. IHDR is always the first chunk, so only the first
+    33 bytes of the file are read.
+
+    :param path: Path of the PNG
+    :return: PngHeader
+    """
+    with open(path, 'rb') as f:
+        head = f.read(33)
+
+    try:
+        return parse_header(head)
+    except ValueError:
+        raise ValueError(f"{path} is not a PNG")
+
+
+def read_headers(paths, workers=16):
+    """
+    Read the headers of many PNGs in parallel. Each read is a single small block, so threads keep several in
+    flight at once.
+
+    :param paths: Paths of the PNGs
+    :param workers: Number of reader threads
+    :return: dict of path to PngHeader, or to None for files that are missing or not PNGs
+    """
+    def header(path):
+        try:
+            return read_header(path)
+        except (OSError, ValueError):
+            return None
+
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(header, paths)))
+
+
+def iter_chunks(f):
+    """
+    Yield the chunks following the IHDR chunk of an open PNG, reading one chunk at a time
+
+    :param f: PNG file positioned after its IHDR chunk
+    :return: generator of (chunk type, data)
+    """
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', head)
+        data = f.read(length)
+        f.read(4)
+        yield chunk_type, data
+
+
+def crop(path, width, height, level=6):
+    """
+    Crop a PNG to its top-left width x height pixels without unfiltering it. PNG filters only refer to pixels to
+    the left of and above the current one, so the first bytes of each filtered scanline are already the filtered
+    scanline of the cropped image. Only the rows that are kept are inflated, and the result is written to a
+    temporary file that replaces path once complete.
+
+    Only non-interlaced greyscale, RGB and alpha images of 8 or 16 bits per channel can be cropped this way;
+    UnsupportedPng is raised for anything else.
+
+    :param path: Path of the PNG, replaced by the cropped image
+    :param width: Maximum width to keep
+    :param height: Maximum height to keep
+    :param level: zlib compression level of the cropped image
+    :return: PngHeader of the cropped image
+    """
+    with open(path, 'rb') as f:
+        try:
+            header = parse_header(f.read(33))
+        except ValueError:
+            raise UnsupportedPng(f"{path} is not a PNG")
+        if header.interlace or header.bit_depth < 8 or header.colour_type not in CHANNELS:
+            raise UnsupportedPng(f"{path} cannot be cropped without decoding it")
+
+        channels = CHANNELS[header.colour_type]
+        pixel = channels * header.bit_depth // 8
+        stride = header.width * pixel + 1
+        width = min(width, header.width)
+        height = min(height, header.height)
+        keep = width * pixel + 1
+
+        writer = PngWriter(f"{path}.tmp", width, height, channels, level, header.bit_depth)
+        try:
+            decompressor = zlib.decompressobj()
+            pending = bytearray()
+            for chunk_type, data in iter_chunks(f):
+                if chunk_type == b'IEND' or writer.rows == height:
+                    break
+                if chunk_type != b'IDAT':
+                    continue
+
+                while data and writer.rows < height:
+                    pending += decompressor.decompress(data, 1 << 20)
+                    data = decompressor.unconsumed_tail
+
+                    count = min(len(pending) // stride, height - writer.rows)
+                    if count:
+                        scanlines = np.frombuffer(bytes(pending[:count * stride]), np.uint8).reshape(count, stride)
+                        writer.write_scanlines(scanlines[:, :keep].tobytes(), count)
+                        del pending[:count * stride]
+
+            writer.close()
+        except Exception:
+            if not writer.file.closed:
+                writer.file.close()
+            os.remove(f"{path}.tmp")
+            raise
+
+    os.replace(f"{path}.tmp", path)
+    return PngHeader(width, height, header.bit_depth, header.colour_type, 0)
+
+
+class PngWriter:
+    """
+    Write a PNG row by row, compressing each batch of rows as it arrives so that the full image never has to be held
+    in memory. write_rows takes 8-bit pixels; write_scanlines also accepts 16-bit data filtered elsewhere.
+    """
+
+    def __init__(self, path, width, height, channels=3, level=6, bit_depth=8):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows = 0
+        self.previous = np.zeros((1, width * channels), dtype=np.uint8)
+        self.compressor = zlib.compressobj(level)
+        self.file = open(path, 'wb')
+
+        ihdr = struct.pack('>IIBBBBB', width, height, bit_depth, COLOUR_TYPES[channels], 0, 0, 0)
+        self.file.write(PNG_SIGNATURE)
+        self.file.write(chunk(b'IHDR', ihdr))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write_rows(self, rows):
+        """
+        Append rows of pixels, in RGB(A) channel order, to the image. Rows are written with the Up filter, which
+        suits screenshots well and can be computed for a whole batch at once.
+
+        :param rows: uint8 array of shape (n, width) or (n, width, channels)
+        :return: None
+        """
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape(len(rows), -1)
+        if rows.shape[1] != self.width * self.channels:
+            raise ValueError(f"Expected rows of width {self.width}, got {rows.shape[1] // self.channels}")
+
+        filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = FILTER_UP
+        filtered[:, 1:] = rows - np.concatenate((self.previous, rows[:-1]))
+        self.previous = rows[-1:].copy()
+
+        self.__write(filtered.tobytes(), len(rows))
+
+    def write_scanlines(self, scanlines, count):
+        """
+        Append already filtered scanlines (filter byte followed by the row data) to the image
+
+        :param scanlines: bytes of count scanlines
+        :param count: Number of scanlines in the data
+        :return: None
+        """
+        self.__write(scanlines, count)
+
+    def __write(self, data, count):
+        if self.rows + count > self.height:
+            raise ValueError(f"Image {self.path} only has {self.height} rows")
+        self.rows += count
+
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.file.write(chunk(b'IDAT', compressed))
+
+    def close(self):
+        if self.rows != self.height:
+            self.file.close()
+            raise ValueError(f"Image {self.path} has {self.rows} of {self.height} rows")
+
+        self.file.write(chunk(b'IDAT', self.compressor.flush()))
+        self.file.write(chunk(b'IEND', b''))
+        self.file.close()
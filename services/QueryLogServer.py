@@ -0,0 +1,85 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from config.app import STORAGE_LOGS_PATH
+from migrations.Response import Response
+from models.Base import Session
+
+
+class QueryLogServer:
+    """
+    Local HTTP server that replays recorded query_*.log files as Alexa API responses. Logs are served in the order
+    they were written, the first for Start=lower, the next for Start=lower + interval and so on. Given a
+    ResponseArchive, it replays the archived responses at their own Start offsets instead. The first `failures`
+    requests for every offset answer with a 503 to exercise retries.
+
+    Usage:
+        with QueryLogServer() as server:
+            Collector(base_url=server.url).run()
+    """
+
+    def __init__(self, logs_path=STORAGE_LOGS_PATH, lower=1, interval=100, failures=0, archive=None):
+        self.responses = {}
+        if archive is not None:
+            session = Session()
+            archived = session.query(Response.start, Response.archive_offset, Response.archive_length) \
+                .filter(Response.archive_offset.isnot(None))
+            for start, offset, length in archived:
+                self.responses[start] = archive.read(offset, length)
+            session.close()
+        else:
+            filenames = sorted(f for f in os.listdir(logs_path) if f.startswith('query_') and f.endswith('.log'))
+            for i, filename in enumerate(filenames):
+                with open(f"{logs_path}/{filename}", 'r') as f:
+                    # Logs start with a timestamp and a blank line before the JSON body
+                    self.responses[lower + i * interval] = f.read().split("\n\n", 1)[1].encode()
+
+        self.failures = failures
+        self.attempts = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api"
+        self.thread = None
+
+    def __handler(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                start = int(parse_qs(urlparse(self.path).query)['Start'][0])
+                attempts = replay.attempts[start] = replay.attempts.get(start, 0) + 1
+
+                if start not in replay.responses:
+                    self.send_response(404)
+                    self.end_headers()
+                elif attempts <= replay.failures:
+                    self.send_response(503)
+                    self.end_headers()
+                else:
+                    body = replay.responses[start]
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,81 @@
+"""
+Columnar export of the ranking dataset in parsed_responses to a NumPy .npz file, one array per column, and import
+back into the table. Missing ranks are stored as 0 and missing metrics as NaN, so every column keeps a fixed-width
+numeric dtype.
+"""
+
+import numpy as np
+
+from config.app import RANKINGS_PATH
+from migrations.ParsedResponse import ParsedResponse
+from models.Base import Session
+
+METRICS = ['reach_per_million', 'page_views_per_million', 'page_views_per_user']
+
+# Rows read or inserted per batch
+BATCH_SIZE = 10000
+
+
+def export_rankings(path=RANKINGS_PATH):
+    """
+    Write every ParsedResponse, ordered by rank, to path
+
+    :param path: .npz file to write
+    :return: int, number of rows written
+    """
+    session = Session()
+    columns = [ParsedResponse.response_id, ParsedResponse.url, ParsedResponse.rank] + \
+              [getattr(ParsedResponse, metric) for metric in METRICS]
+    rows = session.query(*columns).order_by(ParsedResponse.rank.is_(None), ParsedResponse.rank, ParsedResponse.id) \
+        .all()
+    session.close()
+
+    response_ids, urls, ranks, *metrics = zip(*rows) if rows else [()] * len(columns)
+
+    np.savez_compressed(
+        path,
+        response_id=np.array([value or 0 for value in response_ids], dtype=np.int64),
+        url=np.array(urls, dtype=np.str_),
+        rank=np.array([value or 0 for value in ranks], dtype=np.int64),
+        **{metric: np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+           for metric, values in zip(METRICS, metrics)}
+    )
+    return len(urls)
+
+
+def load_rankings(path=RANKINGS_PATH):
+    """
+    Read an exported ranking dataset
+
+    :param path: .npz file written by export_rankings
+    :return: dict of column name to numpy.ndarray
+    """
+    with np.load(path) as data:
+        return {column: data[column] for column in data.files}
+
+
+def import_rankings(path=RANKINGS_PATH, response_ids=True):
+    """
+    Insert an exported ranking dataset into parsed_responses
+
+    :param path: .npz file written by export_rankings
+    :param response_ids: Keep the response each row was parsed from, pass False when importing into a database
+                         without those responses
+    :return: int, number of rows inserted
+    """
+    data = load_rankings(path)
+    session = Session()
+    for start in range(0, len(data['url']), BATCH_SIZE):
+        batch = slice(start, start + BATCH_SIZE)
+        columns = zip(data['response_id'][batch], data['url'][batch], data['rank'][batch],
+                      *(data[metric][batch] for metric in METRICS))
+        session.bulk_insert_mappings(ParsedResponse, [{
+            'response_id': int(response_id) if response_ids and response_id else None,
+            'url': str(url),
+            'rank': int(rank) or None,
+            **{metric: None if np.isnan(value) else float(value) for metric, value in zip(METRICS, values)}
+        } for response_id, url, rank, *values in columns])
+        session.commit()
+
+    session.close()
+    return len(data['url'])
@@ -0,0 +1,59 @@
+"""
+Append-only archive of raw API responses. Each response is compressed into its own gzip member and appended to a
+single file; the offset and length of the member, kept on its Response row, are all that is needed to read it back.
+A sequence of gzip members is itself a valid gzip file, so the whole archive can still be inspected with zcat.
+
+Only one process should append to an archive at a time.
+"""
+
+import gzip
+import io
+import os
+
+from config.app import RESPONSE_ARCHIVE_PATH
+
+
+class ResponseArchive:
+    def __init__(self, path=RESPONSE_ARCHIVE_PATH, level=6):
+        self.path = path
+        self.level = level
+
+    def append(self, data):
+        """
+        Compress data and append it to the archive, syncing it to disk before returning
+
+        :param data: Raw response body
+        :return: tuple of the offset and length of the stored member
+        """
+        member = gzip.compress(data, self.level)
+        with open(self.path, 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+        return offset, len(member)
+
+    def open(self, offset, length):
+        """
+        Stream the response stored at offset. Only the compressed member is held in memory; it is decompressed as
+        the returned file is read.
+
+        :param offset: Offset returned by append
+        :param length: Length returned by append
+        :return: Binary file object
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            member = f.read(length)
+        if len(member) != length:
+            raise ValueError(f"Archive {self.path} ends before the response at {offset}")
+        return gzip.GzipFile(fileobj=io.BytesIO(member))
+
+    def read(self, offset, length):
+        """
+        Decompressed response stored at offset
+
+        :return: bytes
+        """
+        with self.open(offset, length) as f:
+            return f.read()
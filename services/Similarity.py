@@ -0,0 +1,90 @@
+"""
+Local image similarity backends for identify_layout_duplicates. Every backend turns an image into a fingerprint,
+read from the persistent FingerprintCache, and compares fingerprints into a distance between 0 (identical) and 64,
+so SIMILARITY_THRESHOLD means the same thing whichever backend is selected.
+"""
+
+import cv2
+import numpy as np
+
+import services.FingerprintCache as FingerprintCache
+from config.app import SIMILARITY_BACKEND
+
+HASH_BITS = 64
+
+backends = {}
+
+
+def register_backend(name, fingerprint, compare):
+    """
+    Make a similarity backend available by name
+
+    :param name: Name to select the backend by, as in SIMILARITY_BACKEND
+    :param fingerprint: Function taking an image path and returning the value compare() works on
+    :param compare: Function taking two fingerprints and returning their distance
+    :return: None
+    """
+    backends[name] = (fingerprint, compare)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def phash(path):
+    """
+    Perceptual hash: the signs of the lowest 8x8 DCT frequencies of a 32x32 thumbnail relative to their median
+
+    :return: int
+    """
+    return int(FingerprintCache.get(path).phash, 16)
+
+
+def dhash(path):
+    """
+    Difference hash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour
+
+    :return: int
+    """
+    return int(FingerprintCache.get(path).dhash, 16)
+
+
+def ssim_thumbnail(path):
+    return np.float32(cv2.resize(FingerprintCache.thumbnail(path), (128, 128), interpolation=cv2.INTER_AREA))
+
+
+def ssim_distance(a, b):
+    """
+    Structural similarity of two thumbnails, mapped from [-1, 1] onto a distance in [0, 64]
+
+    :return: int
+    """
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    mu_a = cv2.GaussianBlur(a, (11, 11), 1.5)
+    mu_b = cv2.GaussianBlur(b, (11, 11), 1.5)
+    sigma_a = cv2.GaussianBlur(a * a, (11, 11), 1.5) - mu_a * mu_a
+    sigma_b = cv2.GaussianBlur(b * b, (11, 11), 1.5) - mu_b * mu_b
+    sigma_ab = cv2.GaussianBlur(a * b, (11, 11), 1.5) - mu_a * mu_b
+
+    ssim = ((2 * mu_a * mu_b + c1) * (2 * sigma_ab + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (sigma_a + sigma_b + c2))
+    return int(round((1 - float(ssim.mean())) / 2 * HASH_BITS))
+
+
+register_backend('phash', phash, hamming)
+register_backend('dhash', dhash, hamming)
+register_backend('ssim', ssim_thumbnail, ssim_distance)
+
+
+def distance(path_one, path_two, backend=SIMILARITY_BACKEND):
+    """
+    Distance between two images using the given backend, 0 meaning identical
+
+    :param path_one: Path of the first image
+    :param path_two: Path of the second image
+    :param backend: Name of a registered backend
+    :return: int
+    """
+    fingerprint, compare = backends[backend]
+    return compare(fingerprint(path_one), fingerprint(path_two))
@@ -7,3 +7,12 @@ def now():
 
 def time_elapsed(start, end):
     return end - start
+
+
+def file_safe_timestamp():
+    """
+    Get the current timestamp that can be written as part of a file name
+
+    :return: str
+    """
+    return str(now()).replace(" ", "_").replace(".", "-").replace(":", "-")
@@ -0,0 +1,40 @@
+"""
+Find sites whose screenshots look alike using the approximate nearest-neighbour index in services.AnnIndex
+
+    python similar_sites.py build [--source fingerprint|vgg16|...] [--lists N]
+    python similar_sites.py query <host> [-k 10] [--probe 8]
+    python similar_sites.py duplicates [--distance 0.02]
+"""
+
+import argparse
+
+from services.AnnIndex import build_site_index, near_duplicate_sites, similar_sites
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build')
+    build.add_argument('--source', default='fingerprint')
+    build.add_argument('--lists', type=int, default=None)
+
+    query = commands.add_parser('query')
+    query.add_argument('host')
+    query.add_argument('-k', type=int, default=10)
+    query.add_argument('--probe', type=int, default=8)
+
+    duplicates = commands.add_parser('duplicates')
+    duplicates.add_argument('--distance', type=float, default=0.02)
+    duplicates.add_argument('--probe', type=int, default=1)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = build_site_index(args.source, args.lists)
+        print(f"Indexed {len(index.keys)} sites in {len(index.centroids)} partitions")
+    elif args.command == 'query':
+        for site, distance in similar_sites(args.host, args.k, args.probe):
+            print(f"{distance:.4f}\t{site.host}")
+    else:
+        for site, other, distance in near_duplicate_sites(args.distance, args.probe):
+            print(f"{distance:.4f}\t{site.host}\t{other.host}")
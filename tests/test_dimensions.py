@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+# main reads the local config files that are copied from their examples
+pytest.importorskip('config.aws')
+pytest.importorskip('config.openai')
+
+import main
+import services.Png as Png
+from migrations.Screenshot import Screenshot
+from migrations.Site import Site
+from models.Base import Base, create_database_engine
+from models.Screenshot import ScreenshotEnum, write_png
+
+
+@pytest.fixture
+def cluster_data(tmp_path, monkeypatch):
+    engine = create_database_engine(f"sqlite:///{tmp_path}/dimensions.sqlite3")
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(main, 'Session', sessionmaker(bind=engine))
+    monkeypatch.setattr(main, 'CLUSTER_DATA_PATH', str(tmp_path / 'cluster_data'))
+    monkeypatch.setattr(main, 'CROP_HEIGHT', 40)
+    monkeypatch.setattr(main, 'CROP_WIDTH', 30)
+
+    os.makedirs(main.CLUSTER_DATA_PATH)
+    for name, shape in [('tall', (60, 50)), ('short', (30, 20)), ('unknown', (10, 10))]:
+        write_png(f"{main.CLUSTER_DATA_PATH}/{name}.png", np.zeros(shape, dtype=np.uint8))
+
+    session = main.Session()
+    session.add_all([Site(name='tall', host='tall.com'), Site(name='short', host='short.com')])
+    session.commit()
+    session.close()
+    yield main.CLUSTER_DATA_PATH
+    engine.dispose()
+
+
+def recorded(session):
+    return {os.path.basename(path): (height, width) for path, height, width in
+            session.query(Screenshot.path, Screenshot.height, Screenshot.width)
+            .filter_by(type=ScreenshotEnum.CLUSTER_DATA)}
+
+
+def test_constraints_come_from_recorded_copies(cluster_data):
+    assert main.find_dimension_constraints(1) == (30, 20)
+
+    session = main.Session()
+    # Copies that are not named after a site cannot be recorded
+    assert recorded(session) == {'tall.png': (60, 50), 'short.png': (30, 20)}
+    session.close()
+
+
+def test_cropping_records_the_new_dimensions(cluster_data):
+    main.set_image_dimensions(1)
+
+    session = main.Session()
+    assert recorded(session) == {'tall.png': (40, 30), 'short.png': (30, 20)}
+    session.close()
+    header = Png.read_header(f"{cluster_data}/tall.png")
+    assert (header.height, header.width) == (40, 30)
+
+    os.remove(f"{cluster_data}/short.png")
+    assert main.find_dimension_constraints(1) == (40, 30)
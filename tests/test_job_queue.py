@@ -0,0 +1,73 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from migrations.Job import Job
+# Site's relationships need every mapped class it refers to imported
+from migrations.Screenshot import Screenshot  # noqa: F401
+from migrations.Site import Site
+from models.Base import Base, create_database_engine
+from models.Job import JobState
+from models.JobQueue import JobQueue
+
+
+@pytest.fixture
+def session(tmp_path):
+    engine = create_database_engine(f"sqlite:///{tmp_path}/jobs.sqlite3")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([Site(name=f"site{i}", host=f"site{i}.com") for i in range(3)])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def test_claims_are_unique_and_ordered_by_priority(session):
+    jobs = JobQueue(session)
+    jobs.enqueue([1, 2])
+    jobs.enqueue([3], priority=1)
+    assert jobs.enqueue([1]) == 0
+
+    claimed = [jobs.claim(f"worker{i}") for i in range(4)]
+
+    assert [job.site_id for job in claimed[:3]] == [3, 1, 2]
+    assert claimed[3] is None
+
+
+def test_lost_lease_cannot_complete(session):
+    # A negative lease has already expired when it is granted, as if the first worker had stalled
+    stalled = JobQueue(session, lease=-1)
+    stalled.enqueue([1])
+    first = stalled.claim('first')
+
+    second = JobQueue(session).claim('second')
+
+    assert second.id == first.id
+    assert second.attempts == 2
+    assert not stalled.complete(first)
+    assert not stalled.fail(first, 'too late')
+    assert JobQueue(session).complete(second)
+    assert session.query(Job).get(first.id).state == JobState.DONE
+
+
+def test_exhausted_attempts_fail_the_job(session):
+    jobs = JobQueue(session, max_attempts=2)
+    jobs.enqueue([1])
+
+    assert jobs.fail(jobs.claim('worker'), 'first error')
+    assert session.query(Job).get(1).state == JobState.PENDING
+    assert jobs.fail(jobs.claim('worker'), 'second error')
+
+    job = session.query(Job).get(1)
+    assert (job.state, job.attempts, job.error) == (JobState.FAILED, 2, 'second error')
+    assert jobs.claim('worker') is None
+
+
+def test_reap_fails_expired_jobs_out_of_attempts(session):
+    jobs = JobQueue(session, lease=-1, max_attempts=1)
+    jobs.enqueue([1, 2])
+    jobs.claim('crashed')
+
+    assert jobs.reap() == 1
+    assert session.query(Job).get(1).state == JobState.FAILED
+    assert jobs.claim('worker').site_id == 2
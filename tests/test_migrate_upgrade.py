@@ -0,0 +1,91 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+# main reads the local config files that are copied from their examples
+pytest.importorskip('config.aws')
+pytest.importorskip('config.openai')
+
+import main
+from migrations.ParsedResponse import ParsedResponse
+from migrations.Screenshot import Screenshot
+from models.Base import create_database_engine
+from models.Screenshot import ScreenshotEnum
+
+# Tables as created by the original models, before any columns or types changed
+BASELINE_SCHEMA = [
+    """CREATE TABLE sites (
+        id INTEGER NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        host VARCHAR(255) NOT NULL,
+        processed BOOLEAN,
+        PRIMARY KEY (id),
+        UNIQUE (name),
+        UNIQUE (host),
+        CHECK (processed IN (0, 1))
+    )""",
+    """CREATE TABLE responses (
+        id INTEGER NOT NULL,
+        "query" VARCHAR NOT NULL,
+        response JSON NOT NULL,
+        parsed BOOLEAN,
+        PRIMARY KEY (id),
+        CHECK (parsed IN (0, 1))
+    )""",
+    """CREATE TABLE screenshots (
+        id INTEGER NOT NULL,
+        site_id INTEGER,
+        path VARCHAR,
+        type VARCHAR(9),
+        scroll_height INTEGER,
+        time_elapsed VARCHAR,
+        exceeded_height BOOLEAN,
+        failed BOOLEAN,
+        PRIMARY KEY (id),
+        FOREIGN KEY(site_id) REFERENCES sites (id) ON DELETE CASCADE,
+        CONSTRAINT screenshotenum CHECK (type IN ('RGB', 'GREYSCALE')),
+        CHECK (exceeded_height IN (0, 1)),
+        CHECK (failed IN (0, 1))
+    )""",
+    """CREATE TABLE parsed_responses (
+        id INTEGER NOT NULL,
+        response_id INTEGER,
+        url VARCHAR NOT NULL,
+        rank VARCHAR,
+        reach_per_million VARCHAR,
+        page_views_per_million VARCHAR,
+        page_views_per_user VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(response_id) REFERENCES responses (id) ON DELETE CASCADE
+    )""",
+]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_database_engine(f"sqlite:///{tmp_path}/baseline.sqlite3")
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(statement)
+        connection.execute("INSERT INTO sites (id, name, host, processed) VALUES (1, 'site', 'site.com', 1)")
+        connection.execute("INSERT INTO screenshots (id, site_id, path, type, failed) "
+                           "VALUES (1, 1, 'storage/rgb/site.png', 'RGB', 0)")
+        connection.execute("INSERT INTO parsed_responses (id, url, rank) VALUES (1, 'site.com', '10')")
+    yield engine
+    engine.dispose()
+
+
+def test_upgrade_allows_every_screenshot_type(engine):
+    main.migrate_upgrade(engine)
+    main.migrate_upgrade(engine)
+
+    session = sessionmaker(bind=engine)()
+    session.add(Screenshot(site_id=1, path='storage/cluster/site.png', type=ScreenshotEnum.CROPPED))
+    session.commit()
+
+    screenshots = session.query(Screenshot).order_by(Screenshot.id).all()
+    assert [(screenshot.path, screenshot.type) for screenshot in screenshots] == [
+        ('storage/rgb/site.png', ScreenshotEnum.RGB),
+        ('storage/cluster/site.png', ScreenshotEnum.CROPPED),
+    ]
+    assert session.query(ParsedResponse.rank).scalar() == 10
+    session.close()
@@ -0,0 +1,43 @@
+import cv2
+import numpy as np
+import pytest
+
+from services.Png import UnsupportedPng, crop, read_header
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+@pytest.mark.parametrize('channels', [1, 3, 4])
+def test_crop_matches_slicing(tmp_path, dtype, channels):
+    # Noise makes the encoder use every filter type across the scanlines
+    shape = (120, 97) if channels == 1 else (120, 97, channels)
+    image = np.random.RandomState(728).randint(0, np.iinfo(dtype).max, shape, dtype=dtype)
+    path = str(tmp_path / 'image.png')
+    cv2.imwrite(path, image)
+
+    header = crop(path, 61, 45)
+
+    cropped = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    assert cropped.dtype == dtype
+    assert np.array_equal(cropped, image[:45, :61])
+    assert (header.width, header.height) == (61, 45)
+    assert read_header(path)[:4] == header[:4]
+
+
+def test_crop_keeps_images_within_bounds(tmp_path):
+    image = np.random.RandomState(728).randint(0, 255, (30, 40, 3), dtype=np.uint8)
+    path = str(tmp_path / 'image.png')
+    cv2.imwrite(path, image)
+
+    crop(path, 100, 100)
+
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), image)
+
+
+def test_crop_rejects_other_files(tmp_path):
+    path = tmp_path / 'image.png'
+    path.write_bytes(b'not a png' * 10)
+
+    with pytest.raises(UnsupportedPng):
+        crop(str(path), 10, 10)
+    assert path.read_bytes() == b'not a png' * 10
+    assert not (tmp_path / 'image.png.tmp').exists()